@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/2.1/ref/settings/
 """
 
 import os
+import tempfile
 from decouple import config
 import pusher
 import dj_database_url
@@ -68,11 +69,14 @@ EMAIL_BACKEND = 'django.core.mail.backends.console.EmailBackend'
 SITE_ID = 1
 
 MIDDLEWARE = [
+    'adventure.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    # After AuthenticationMiddleware, so it knows who asked to be profiled
+    'adventure.profiling.ProfileMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -122,8 +126,10 @@ if DEBUG:
     }
 else:
     DATABASES = {}
-    DATABASES['default'] = dj_database_url.config(conn_max_age=500, ssl_require=True)
-    DATABASES['default'] = dj_database_url.parse(config('DATABASE_URL'),conn_max_age=500)
+    # Seconds a database connection is reused (gevent workers use a pool instead, see below)
+    conn_max_age = config('DB_CONN_MAX_AGE', default=500, cast=int)
+    DATABASES['default'] = dj_database_url.config(conn_max_age=conn_max_age, ssl_require=True)
+    DATABASES['default'] = dj_database_url.parse(config('DATABASE_URL'),conn_max_age=conn_max_age)
 
 # Password validation
 # https://docs.djangoproject.com/en/2.1/ref/settings/#auth-password-validators
@@ -149,15 +155,53 @@ REST_FRAMEWORK = {
     # 'DEFAULT_PERMISSION_CLASSES': [
     #     'rest_framework.permissions.DjangoModelPermissionsOrAnonReadOnly',
     # ],
+    # Requests without a valid token get a 401 rather than reaching the views
+    'DEFAULT_PERMISSION_CLASSES': (
+        'rest_framework.permissions.IsAuthenticated',
+    ),
+    # Token auth only: BasicAuthentication hashed the password on every request
     'DEFAULT_AUTHENTICATION_CLASSES': (
-        'rest_framework.authentication.BasicAuthentication',
-        'rest_framework.authentication.SessionAuthentication',
-        'rest_framework.authentication.TokenAuthentication',
+        'adventure.authentication.CachedTokenAuthentication',
     ),
 }
 
 CORS_ORIGIN_ALLOW_ALL=True
 
+# Number of prebuilt games kept ready for every board size (see adventure/lobby_pool.py)
+LOBBY_POOL_DEPTH = config('LOBBY_POOL_DEPTH', default=2, cast=int)
+
+# Seconds a worker remembers which user an auth token belongs to (see adventure/authentication.py)
+TOKEN_CACHE_TTL = config('TOKEN_CACHE_TTL', default=30, cast=float)
+
+# Number of games whose maze topology each worker keeps in memory (see adventure/maze_cache.py)
+MAZE_CACHE_SIZE = config('MAZE_CACHE_SIZE', default=256, cast=int)
+
+# How real-time notifications reach players: 'pusher', or 'local' to stream
+# them from this process at /api/adv/events/ (see adventure/transport.py).
+# 'local' needs a single web worker; gunicorn.conf.py refuses to start otherwise
+EVENT_TRANSPORT = config('EVENT_TRANSPORT', default='pusher')
+
+# Send real-time notifications from a background queue after the response (see adventure/dispatch.py)
+BROADCAST_ASYNC = config('BROADCAST_ASYNC', default=True, cast=bool)
+BROADCAST_QUEUE_SIZE = config('BROADCAST_QUEUE_SIZE', default=1000, cast=int)
+# More than one worker sends faster but can reorder a player's events
+BROADCAST_WORKERS = config('BROADCAST_WORKERS', default=1, cast=int)
+BROADCAST_RETRIES = config('BROADCAST_RETRIES', default=3, cast=int)
+
+# Where players' positions live during a game: 'database', or 'memory' to
+# keep each game in progress in this process and write it out every
+# ENGINE_FLUSH_INTERVAL seconds. 'memory' needs every request of a game to
+# reach the same process, so gunicorn.conf.py refuses more than one web
+# worker (see adventure/engine.py)
+GAME_ENGINE = config('GAME_ENGINE', default='database')
+ENGINE_FLUSH_INTERVAL = config('ENGINE_FLUSH_INTERVAL', default=1.0, cast=float)
+
+# Record per-view timings and query counts, served at /metrics (see adventure/metrics.py)
+METRICS_ENABLED = config('METRICS_ENABLED', default=False, cast=bool)
+
+# Where profiles from /admin/profile/ and X-Profile requests are written (see adventure/profiling.py)
+PROFILE_DIR = config('PROFILE_DIR', default=tempfile.gettempdir())
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.1/topics/i18n/
 
@@ -179,3 +223,15 @@ STATIC_URL = '/static/'
 
 import django_heroku
 django_heroku.settings(locals())
+if not DEBUG:
+    # django_heroku replaces the database settings with its own
+    # CONN_MAX_AGE; keep DB_CONN_MAX_AGE
+    DATABASES['default']['CONN_MAX_AGE'] = conn_max_age
+    # Under gevent (set by gunicorn.conf.py) each greenlet would connect to
+    # Postgres for every request. They take connections from a shared pool
+    # of up to DB_POOL_SIZE instead
+    if (config('DB_GEVENT_POOL', default=False, cast=bool) and
+            DATABASES['default']['ENGINE'].startswith('django.db.backends.postgresql')):
+        DATABASES['default']['ENGINE'] = 'django_db_geventpool.backends.postgresql_psycopg2'
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS']['MAX_CONNS'] = config('DB_POOL_SIZE', default=20, cast=int)
@@ -1,9 +1,13 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.conf.urls import include
+from adventure.metrics import metrics_view
+from adventure.profiling import profile_view
 
 urlpatterns = [
+    path('admin/profile/', profile_view),
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
     path('api/adv/', include('adventure.urls')),
+    path('metrics', metrics_view),
 ]
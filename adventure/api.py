@@ -2,29 +2,51 @@ from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from django.forms.models import model_to_dict
 from django.contrib.auth.models import User
-from django.http import JsonResponse
-from rest_framework.decorators import api_view
-from pusher import Pusher
-from decouple import config
+from django.db import connection
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from rest_framework.decorators import api_view, authentication_classes
+from rest_framework.settings import api_settings
 from .models import *
+from .create_maze import ALGORITHMS, DEFAULT_ALGORITHM
+from .lobby_pool import claim_game, request_refill
+from .reaper import request_reap
+from .maze_cache import invalidate as invalidate_topology
+from .broadcast import Broadcast, player_channel
+from .transport import get_transport
+from .authentication import QueryTokenAuthentication
+from .context import with_context
+from . import engine
+from .dispatch import get_dispatcher
 import json
 import sys
 
-# instantiate pusher
-pusher = Pusher(
-    app_id=config('PUSHER_APP_ID'),
-    key=config('PUSHER_KEY'),
-    secret=config('PUSHER_SECRET'),
-    cluster=config('PUSHER_CLUSTER'),
-    ssl=True,
-)
+# Pusher, or the self-hosted stream served by the events view (EVENT_TRANSPORT)
+transport = get_transport()
+
+# How many times move retries a step that lost a race with another move
+MOVE_ATTEMPTS = 3
+# Longest list of directions walk accepts
+MAX_WALK_STEPS = 200
+# Widest board joinlobby builds. Wider ones come from create_mega_maze
+MAX_COLUMNS = 10
+# Boards with more rooms than this leave the room list out of get_game,
+# init and join; their clients use get_maze?compact=1 instead
+MAX_MAZE_PAYLOAD_ROOMS = 10000
+
+
+def maze_payload(game, all_rooms):
+    if game.num_rooms() > MAX_MAZE_PAYLOAD_ROOMS:
+        return []
+    return all_rooms()
+
 
 @csrf_exempt
 @api_view(['GET'])
+@with_context
 def get_game(request):
-    player = request.user.player
-    player_id = player.user.id
-    game = player.game()
+    context = request.context
+    player = context.player
+    game = context.game
 
     if not game:
         return JsonResponse({
@@ -36,9 +58,9 @@ def get_game(request):
         },
         'message': 'You are not in a game or game lobby!'}, safe=True)
 
-    current_room = player.room()
-    rooms_list = game.all_rooms()
-    uuids = current_room.player_UUIDs(player_id)
+    current_room = context.room
+    rooms_list = maze_payload(game, context.all_rooms)
+    usernames, uuids = context.occupants(current_room.id)
 
     response_object = {
         'error': False,
@@ -51,7 +73,7 @@ def get_game(request):
             'id': game.id,
             'in_progress': game.in_progress,
             'uuids': uuids,
-            'usernames': current_room.player_usernames(player_id),
+            'usernames': usernames,
             'num_players': len(uuids) + 1,
             'map_columns': game.map_columns
         },
@@ -60,7 +82,7 @@ def get_game(request):
             'description': current_room.description,
             'visited': current_room.visited,
             'end': current_room.end,
-            'players': current_room.player_usernames(player_id),
+            'players': usernames,
             'loc': current_room.id,
             'n': current_room.n,
             's': current_room.s,
@@ -70,33 +92,28 @@ def get_game(request):
         'maze': rooms_list
     }
 
-    for p_uuid in uuids:
-        if not game.in_progress:
-            pusher.trigger(f'p-channel-{p_uuid}', u'broadcast',
-                {'message': f'{player.user.username} has entered the lobby', 'joining': 'joining lobby'})
-        else:
-            pusher.trigger(f'p-channel-{p_uuid}', u'broadcast',
-                {'message': f'{player.user.username} has joined the game', 'joining': 'joining the game'})
-
+    # Joining is announced by joinlobby when it happens, so polling this
+    # stays a pure read
     return JsonResponse(response_object, safe=True)
 
 
 @csrf_exempt
 @api_view(['GET'])
+@with_context
 def initialize(request):
-    player = request.user.player
-    player_id = player.user.id
-    game = player.game()
+    context = request.context
+    player = context.player
+    game = context.game
 
     if game is not None:
         game.in_progress = True
-        game.save()
+        game.save(update_fields=['in_progress'])
     else:
         return JsonResponse({'message': 'Game has ended please join a new lobby'}, safe=True)
 
-    current_room = player.room()
-    rooms_list = game.all_rooms()
-    uuids = current_room.player_UUIDs(player_id)
+    current_room = context.room
+    rooms_list = maze_payload(game, context.all_rooms)
+    usernames, uuids = context.occupants(current_room.id)
 
     response_object = {
         'user': {
@@ -107,7 +124,7 @@ def initialize(request):
             'id': game.id,
             'in_progress': game.in_progress,
             'uuids': uuids,
-            'usernames': current_room.player_usernames(player_id),
+            'usernames': usernames,
             'num_players': len(uuids) + 1
         },
         'current_room': {
@@ -115,7 +132,7 @@ def initialize(request):
             'description': current_room.description,
             'visited': current_room.visited,
             'end': current_room.end,
-            'players': current_room.player_usernames(player_id),
+            'players': usernames,
             'loc': current_room.id,
             'n': current_room.n,
             's': current_room.s,
@@ -125,38 +142,45 @@ def initialize(request):
         'maze': rooms_list
     }
 
-    for p_uuid in uuids:
-        pusher.trigger(
-            f'p-channel-{p_uuid}', u'broadcast', {'message': f'game starting', 'init': 'Game initializing'})
+    events = Broadcast(transport, get_dispatcher())
+    events.send(uuids, {'message': f'game starting', 'init': 'Game initializing'})
+    events.flush()
 
     return JsonResponse(response_object, safe=True)
 
 
 @csrf_exempt
 @api_view(['GET'])
+@with_context
 def joinlobby(request):
 
     no_preference = False
     try:
         columns_given = request.query_params.get('columns')
-        columns = int(columns_given)
-        if columns > 10:
-            columns = 10
+        columns = requested_columns = int(columns_given)
+        if columns > MAX_COLUMNS:
+            columns = MAX_COLUMNS
         elif columns < 2:
             columns = 2
     except:
         columns = 5
+        requested_columns = None
         no_preference = True
 
-    user = request.user
-    player = user.player
+    algorithm = request.query_params.get('algorithm')
+    if algorithm not in ALGORITHMS:
+        algorithm = None
+
+    context = request.context
+    player = context.player
     player_id = player.user.id
     uuid = player.uuid
-    existing_game = player.game()
+    existing_game = context.game
 
     if existing_game is not None:
-        current_room = player.room()
-        rooms_list = existing_game.all_rooms()
+        current_room = context.room
+        rooms_list = maze_payload(existing_game, context.all_rooms)
+        usernames, uuids = context.occupants(current_room.id)
 
         return JsonResponse({
         'user': {
@@ -166,16 +190,16 @@ def joinlobby(request):
         'game': {
             'id': existing_game.id,
             'in_progress': existing_game.in_progress,
-            'uuids': current_room.player_UUIDs(player_id),
-            'usernames': current_room.player_usernames(player_id),
-            'num_players': existing_game.num_players()
+            'uuids': uuids,
+            'usernames': usernames,
+            'num_players': context.num_players
         },
         'current_room': {
             'title': current_room.title,
             'description': current_room.description,
             'visited': current_room.visited,
             'end': current_room.end,
-            'players': current_room.player_usernames(player_id),
+            'players': usernames,
             'loc': current_room.id,
             'n': current_room.n,
             's': current_room.s,
@@ -185,25 +209,41 @@ def joinlobby(request):
         'maze': rooms_list
     }, safe=True)
 
-    if no_preference and Game.objects.filter(in_progress=False):
-        new_game = Game.objects.get(in_progress=False)
-    elif Game.objects.filter(in_progress=False, map_columns=columns):
-        # Todo: If player already joined the lobby will this break??
-        # It only calls player.initialize(new_game.id, new_game.min_room_id) so maybe not???
-        new_game = Game.objects.get(in_progress=False)
+    open_games = Game.objects.filter(in_progress=False, pooled=False, finished=False)
+    if algorithm:
+        open_games = open_games.filter(algorithm=algorithm)
+
+    # The oldest open lobby is filled first
+    open_games = open_games.order_by('id')
+    # Mega mazes only take players who ask for their exact size, and are
+    # never built here
+    mega_game = None
+    if requested_columns is not None and requested_columns > MAX_COLUMNS:
+        mega_game = open_games.filter(map_columns=requested_columns).first()
+    open_games = open_games.filter(map_columns__lte=MAX_COLUMNS)
+    if mega_game is not None:
+        new_game = mega_game
+    elif no_preference and open_games:
+        new_game = open_games.first()
+    elif open_games.filter(map_columns=columns):
+        new_game = open_games.filter(map_columns=columns).first()
     else:
-        new_game = Game(map_columns=columns, in_progress=False)
-        new_game.generate_rooms()
-        new_game.generate_maze()
-        new_game.generate_end()
-
-    for p_uuid in new_game.get_games_UUIDs(uuid):
-        pusher.trigger(f'p-channel-{p_uuid}', u'broadcast',
-                       {'message': f'{player.user.username} has entered the lobby', 'joining': 'joining lobby'})
-    player.initialize(new_game.id, new_game.min_room_id)
-    player.save()
+        new_game = claim_game(columns, algorithm or DEFAULT_ALGORITHM)
+        if new_game is None:
+            new_game = Game(map_columns=columns, in_progress=False,
+                            algorithm=algorithm or DEFAULT_ALGORITHM)
+            new_game.create_world()
+        if new_game.algorithm == DEFAULT_ALGORITHM:
+            request_refill(columns)
+
+    if player.join_game(new_game):
+        events = Broadcast(transport, get_dispatcher())
+        events.send(new_game.get_games_UUIDs(uuid),
+                    {'message': f'{player.user.username} has entered the lobby', 'joining': 'joining lobby'})
+        events.flush()
     current_room = player.room()
-    rooms_list = new_game.all_rooms()
+    rooms_list = maze_payload(new_game, new_game.all_rooms)
+    usernames, uuids = current_room.occupants(player_id)
 
     return JsonResponse({
         'user': {
@@ -213,8 +253,8 @@ def joinlobby(request):
         'game': {
             'id': new_game.id,
             'in_progress': new_game.in_progress,
-            'uuids': current_room.player_UUIDs(player_id),
-            'usernames': current_room.player_usernames(player_id),
+            'uuids': uuids,
+            'usernames': usernames,
             'num_players': new_game.num_players()
         },
         'current_room': {
@@ -222,7 +262,7 @@ def joinlobby(request):
             'description': current_room.description,
             'visited': current_room.visited,
             'end': current_room.end,
-            'players': current_room.player_usernames(player_id),
+            'players': usernames,
             'loc': current_room.id,
             'n': current_room.n,
             's': current_room.s,
@@ -235,72 +275,67 @@ def joinlobby(request):
 
 @csrf_exempt
 @api_view(['POST'])
+@with_context
 def move(request):
     dirs = {'n': 'north', 's': 'south', 'e': 'east', 'w': 'west'}
-    direction = json.loads(request.body)['direction'].lower()
+    data = json.loads(request.body)
+    direction = data['direction'].lower()
 
     if direction not in dirs.keys():
         return JsonResponse({
             'in_progress': True,
             'error': True,
             'message': 'Invalid Direction'}, safe=True)
-    else:
-        player = request.user.player
-        room = player.room()
-        if room:
-            next_room_id = model_to_dict(room).get(direction, -1)
-        else:
+
+    context = request.context
+    player = context.player
+    current_game = context.game
+    # The maze never changes once generated, so exits, titles and the
+    # end room come from the in-process cache rather than the database
+    topology = context.topology
+    # Each attempt starts from the room the database says the player is in.
+    # If another request moved them first, the step is retried from there
+    for attempt in range(MOVE_ATTEMPTS):
+        room = topology.room(player.current_room) if topology else None
+        if not room:
             return JsonResponse({
                 'in_progress': False,
                 'error': True,
                 'message': 'The game has already ended! Someone found the end of the maze!!'
             }, safe=True)
+        next_room_id = getattr(room, direction)
+        if not current_game.in_progress or next_room_id == -1 or context.step(room.id, next_room_id):
+            break
+    else:
+        return JsonResponse({
+            'in_progress': True,
+            'error': True,
+            'message': 'Too many moves at once, try again.'
+        }, safe=True)
 
     reverse_dirs = {'n': 'south', 's': 'north', 'e': 'west', 'w': 'east'}
-    player_id = player.user.id
-    player_uuid = player.uuid
-    current_game = player.game()
 
-    if current_game and current_game.in_progress and next_room_id != -1:
-        next_room = Room.objects.get(id=next_room_id)
-        player.moves += 1
+    if current_game.in_progress and next_room_id != -1:
+        next_room = topology.room(next_room_id)
 
         if next_room.end:
-            player_uuid = player.uuid
-            for p_uuid in current_game.get_games_UUIDs(player_uuid):
-                pusher.trigger(f'p-channel-{p_uuid}', u'broadcast',
-                               {'message': f'{player.user.username} has completed the maze', 'ending': 'maze completed'})
-            min_room_id = current_game.min_room_id
-            max_room_id = min_room_id+current_game.num_rooms()-1
-            current_game.reset_players()
-            Room.objects.filter(id__gte=min_room_id,
-                                id__lte=max_room_id).delete()
-            Game.objects.filter(id=current_game.id).delete()
-
-            return JsonResponse({
-                'in_progress': False,
-                'error': False,
-                'message': 'Congratulations! You found the end of the maze!!'}, safe=True)
+            return complete_maze(context)
         else:
-            player.current_room = next_room_id
-            player.save()
-            next_room.visited = True
-            next_room.save()
-            players = next_room.player_usernames(player_id)
-            current_player_UUIDs = room.player_UUIDs(player_id)
-            next_player_UUIDs = next_room.player_UUIDs(player_id)
-            for p_uuid in current_player_UUIDs:
-                pusher.trigger(f'p-channel-{p_uuid}', u'broadcast', {
-                               'message': f'{player.user.username} has walked {dirs[direction]}.'})
-            for p_uuid in next_player_UUIDs:
-                pusher.trigger(f'p-channel-{p_uuid}', u'broadcast', {
-                               'message': f'{player.user.username} has entered from the {reverse_dirs[direction]}.'})
-            return JsonResponse({
+            context.load_occupants([room.id, next_room.id])
+            current_player_UUIDs = context.occupants(room.id)[1]
+            players, next_player_UUIDs = context.occupants(next_room.id)
+            events = Broadcast(transport, get_dispatcher())
+            events.send(current_player_UUIDs, {
+                        'message': f'{player.user.username} has walked {dirs[direction]}.'})
+            events.send(next_player_UUIDs, {
+                        'message': f'{player.user.username} has entered from the {reverse_dirs[direction]}.'})
+            events.flush()
+            response = {
                 'name': player.user.username,
                 'title': next_room.title,
                 'description': next_room.description,
                 'players': players,
-                'num_players': current_game.num_players(),
+                'num_players': context.num_players,
                 'loc': next_room.id,
                 'n': next_room.n,
                 's': next_room.s,
@@ -308,13 +343,10 @@ def move(request):
                 'w': next_room.w,
                 'moves': player.moves,
                 'in_progress': True,
-                'error': False}, safe=True)
-    elif current_game == None:
-        return JsonResponse({
-            'in_progress': False,
-            'error': True,
-            'message': 'The game has already ended! Someone found their way to the end of the maze!!'
-        }, safe=True)
+                'error': False}
+            if data.get('distance'):
+                response['distance'] = topology.distance(next_room.id)
+            return JsonResponse(response, safe=True)
     elif not current_game.in_progress:
         return JsonResponse({
             'in_progress': False,
@@ -322,14 +354,14 @@ def move(request):
             'message': 'Game has not started yet'
         }, safe=True)
     else:
-        players = room.player_usernames(player_id)
+        players = context.occupants(room.id)[0]
         return JsonResponse({
             'in_progress': True,
             'name': player.user.username,
             'title': room.title,
             'description': room.description,
             'players': players,
-            'num_players': current_game.num_players(),
+            'num_players': context.num_players,
             'loc': room.id,
             'n': room.n,
             's': room.s,
@@ -340,55 +372,212 @@ def move(request):
         }, safe=True)
 
 
+def complete_maze(context):
+    # The player reached the end room. Only the first player to get there
+    # wins; the game is left for the reaper to clear
+    player = context.player
+    current_game = context.game
+    player_UUIDs = context.other_uuids()
+    engine.close(current_game.id)
+    if not current_game.finish():
+        return JsonResponse({
+            'in_progress': False,
+            'error': True,
+            'message': 'The game has already ended! Someone found the end of the maze!!'
+        }, safe=True)
+    invalidate_topology(current_game.id)
+    request_reap()
+    events = Broadcast(transport, get_dispatcher())
+    events.send(player_UUIDs,
+                {'message': f'{player.user.username} has completed the maze', 'ending': 'maze completed'})
+    events.flush()
+
+    return JsonResponse({
+        'in_progress': False,
+        'error': False,
+        'message': 'Congratulations! You found the end of the maze!!'}, safe=True)
+
+
+@csrf_exempt
+@api_view(['POST'])
+@with_context
+def walk(request):
+    # Several moves in one request: a list of directions, or a target room
+    # to walk to along the shortest route. The walk stops early at a wall or
+    # the end room and is applied with a single conditional update
+    dirs = {'n': 'north', 's': 'south', 'e': 'east', 'w': 'west'}
+    reverse_dirs = {'n': 'south', 's': 'north', 'e': 'west', 'w': 'east'}
+    data = json.loads(request.body)
+    context = request.context
+    player = context.player
+    current_game = context.game
+    topology = context.topology
+    if not topology:
+        return JsonResponse({
+            'in_progress': False,
+            'error': True,
+            'message': 'The game has already ended! Someone found the end of the maze!!'
+        }, safe=True)
+    if not current_game.in_progress:
+        return JsonResponse({
+            'in_progress': False,
+            'error': True,
+            'message': 'Game has not started yet'
+        }, safe=True)
+
+    target = None
+    if 'target' in data:
+        try:
+            target = int(data['target'])
+        except (TypeError, ValueError):
+            return JsonResponse({'in_progress': True, 'error': True, 'message': 'Invalid Target'}, safe=True)
+    else:
+        directions = data.get('directions', [])
+        if not isinstance(directions, list) or not all(isinstance(direction, str) for direction in directions):
+            return JsonResponse({'in_progress': True, 'error': True, 'message': 'Invalid Direction'}, safe=True)
+        directions = [direction.lower() for direction in directions]
+        if any(direction not in dirs for direction in directions):
+            return JsonResponse({'in_progress': True, 'error': True, 'message': 'Invalid Direction'}, safe=True)
+
+    for attempt in range(MOVE_ATTEMPTS):
+        start = player.current_room
+        if start not in topology:
+            return JsonResponse({
+                'in_progress': False,
+                'error': True,
+                'message': 'The game has already ended! Someone found the end of the maze!!'
+            }, safe=True)
+        if target is not None:
+            directions = topology.path(start, target)
+            if directions is None:
+                return JsonResponse({'in_progress': True, 'error': True, 'message': 'Invalid Target'}, safe=True)
+        if len(directions) > MAX_WALK_STEPS:
+            return JsonResponse({
+                'in_progress': True,
+                'error': True,
+                'message': f'You can walk at most {MAX_WALK_STEPS} steps at once'
+            }, safe=True)
+
+        rooms, stopped = topology.walk(start, directions)
+        if not rooms or context.step(start, rooms[-1], rooms):
+            break
+    else:
+        return JsonResponse({
+            'in_progress': True,
+            'error': True,
+            'message': 'Too many moves at once, try again.'
+        }, safe=True)
+
+    if stopped == 'end':
+        return complete_maze(context)
+
+    # One message per room the walk touched, sent together. Rooms only
+    # passed through all get the same message, so they share one trigger
+    name = player.user.username
+    context.load_occupants([start] + rooms)
+    events = Broadcast(transport, get_dispatcher())
+    if rooms:
+        events.send(context.occupants(start)[1], {'message': f'{name} has walked {dirs[directions[0]]}.'})
+        for room_id in rooms[:-1]:
+            events.send(context.occupants(room_id)[1], {'message': f'{name} passed through.'})
+        events.send(context.occupants(rooms[-1])[1], {
+            'message': f'{name} has entered from the {reverse_dirs[directions[len(rooms) - 1]]}.'})
+    events.flush()
+
+    room = topology.room(player.current_room)
+    players = context.occupants(room.id)[0]
+    response = {
+        'name': name,
+        'title': room.title,
+        'description': room.description,
+        'players': players,
+        'num_players': context.num_players,
+        'loc': room.id,
+        'n': room.n,
+        's': room.s,
+        'e': room.e,
+        'w': room.w,
+        'moves': player.moves,
+        'path': rooms,
+        'in_progress': True,
+        'error': False}
+    if data.get('distance'):
+        response['distance'] = topology.distance(room.id)
+    if stopped == 'wall':
+        response['error'] = True
+        response['message'] = 'You cannot move that way.'
+    return JsonResponse(response, safe=True)
+
+
+@csrf_exempt
+@api_view(['GET'])
+@with_context
+def hint(request):
+    # The next step toward the end, looked up in the distances precomputed
+    # when the maze was generated
+    player = request.context.player
+    topology = request.context.topology
+    if not topology or player.current_room not in topology:
+        return JsonResponse({'error': True, 'message': 'You are not in a game'})
+    direction = topology.hint(player.current_room)
+    if direction is None:
+        return JsonResponse({'error': True, 'message': 'There are no hints for this maze'})
+    return JsonResponse({
+        'error': False,
+        'loc': player.current_room,
+        'direction': direction,
+        'distance': topology.distance(player.current_room)})
+
+
 @csrf_exempt
 @api_view(['POST'])
+@with_context
 def say(request):
-    player = request.user.player
-    player_id = player.user.id
-    player_uuid = player.uuid
+    context = request.context
+    player = context.player
     data = json.loads(request.body)
     message = data['message']
-    room = player.room()
-    player_UUIDs = room.player_UUIDs(player_id)
-    print("UUIDS: ", player_UUIDs)
-    for p_uuid in player_UUIDs:
-        pusher.trigger(f'p-channel-{p_uuid}', u'broadcast',
-                       {'message': f'{player.user.username}: {message}'})
-
-    players = room.player_usernames(player_uuid)
+    if not context.game:
+        return JsonResponse({'error': True, 'message': 'You are not in a game'})
+    events = Broadcast(transport, get_dispatcher())
+    events.send(context.occupants(player.current_room)[1], {'message': f'{player.user.username}: {message}'})
+    events.flush()
+
     return JsonResponse({'message': message}, safe=True)
 
 
 @csrf_exempt
 @api_view(['POST'])
+@with_context
 def shout(request):
-    player = request.user.player
-    player_uuid = player.uuid
+    player = request.context.player
     data = json.loads(request.body)
     message = data['message']
-    game = player.game()
-    for p_uuid in game.get_games_UUIDs(player_uuid):
-        pusher.trigger(f'p-channel-{p_uuid}', u'broadcast',
-                       {'message': f'{player.user.username}: {message}'})
+    game = request.context.game
+    if not game:
+        return JsonResponse({'error': True, 'message': 'You are not in a game'})
+    events = Broadcast(transport, get_dispatcher())
+    events.send(request.context.other_uuids(), {'message': f'{player.user.username}: {message}'})
+    events.flush()
     return JsonResponse({'message_to_channel': message}, safe=True)
 
 
 @csrf_exempt
 @api_view(['GET'])
+@with_context
 def end(request):
-    player = request.user.player
-    current_game = player.game()
-    if current_game and current_game.num_players() == 1:
-        min_room_id = current_game.min_room_id
-        max_room_id = min_room_id+current_game.num_rooms()-1
-        current_game.reset_players()
-        Room.objects.filter(id__gte=min_room_id, id__lte=max_room_id).delete()
-        Game.objects.filter(id=current_game.id).delete()
+    context = request.context
+    current_game = context.game
+    if current_game and context.num_players == 1:
+        engine.close(current_game.id)
+        current_game.finish(started=False)
+        invalidate_topology(current_game.id)
+        request_reap()
         return JsonResponse({
             'in_progress': False,
             'error': False,
             'message': 'Game quit!'}, safe=True)
-    elif current_game and current_game.num_players() > 1:
+    elif current_game and context.num_players > 1:
         return JsonResponse({
             'in_progress': True,
             'error': True,
@@ -404,10 +593,67 @@ def end(request):
 
 @csrf_exempt
 @api_view(['GET'])
+@with_context
 def get_maze(request):
-    player = request.user.player
-    current_game = player.game()
+    current_game = request.context.game
+    if not current_game:
+        return JsonResponse({'error': True, 'message': 'You are not in a game'})
+    if not request.query_params.get('compact'):
+        return JsonResponse({'error': False, 'maze': request.context.all_rooms()})
+
+    # The compact maze is static, so clients revalidate it with If-None-Match
+    # and fetch visited rooms separately from get_visited
+    topology = request.context.topology
+    if topology is None:
+        return JsonResponse({'error': True, 'message': 'This game has no maze yet'})
+    if request.META.get('HTTP_IF_NONE_MATCH') == topology.etag:
+        response = HttpResponse(status=304)
+    else:
+        response = HttpResponse(topology.compact_json(), content_type='application/json')
+    response['ETag'] = topology.etag
+    return response
+
+
+@csrf_exempt
+@api_view(['GET'])
+@with_context
+def get_visited(request):
+    current_game = request.context.game
     if current_game:
-        return JsonResponse({'error': False, 'maze': current_game.all_rooms()})
+        return JsonResponse({'error': False, 'visited': request.context.visited_room_ids()})
     else:
         return JsonResponse({'error': True, 'message': 'You are not in a game'})
+
+
+@csrf_exempt
+@api_view(['GET'])
+@authentication_classes([QueryTokenAuthentication] + list(api_settings.DEFAULT_AUTHENTICATION_CLASSES))
+def events(request):
+    # Server-Sent Events stream of this player's p-channel, for the
+    # self-hosted transport
+    if not hasattr(transport, 'subscribe'):
+        return JsonResponse({'error': True, 'message': 'Events are delivered through Pusher'}, status=404)
+
+    player = request.user.player
+    subscription = transport.subscribe(player_channel(player.uuid))
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                event = subscription.get(timeout=15)
+                if event is None:
+                    yield ': keepalive\n\n'
+                else:
+                    name, data = event
+                    yield f'event: {name}\ndata: {json.dumps(data, default=str)}\n\n'
+        finally:
+            transport.unsubscribe(subscription)
+
+    # The stream never touches the database, so its connection is handed
+    # back now rather than held for as long as the client stays connected
+    connection.close()
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from .context import load_player
+from .models import Player
+
+_lock = threading.Lock()
+# Token key -> (user id, expiry), oldest first
+_tokens = OrderedDict()
+
+
+def cached_user_id(key):
+    with _lock:
+        entry = _tokens.get(key)
+    if entry is None or entry[1] < time.monotonic():
+        return None
+    return entry[0]
+
+
+def remember(key, user_id):
+    now = time.monotonic()
+    with _lock:
+        # Every entry lives for the same TTL, so expired ones are at the front
+        while _tokens and next(iter(_tokens.values()))[1] < now:
+            _tokens.popitem(last=False)
+        _tokens.pop(key, None)
+        _tokens[key] = (user_id, now + settings.TOKEN_CACHE_TTL)
+
+
+def forget(key):
+    with _lock:
+        _tokens.pop(key, None)
+
+
+@receiver(post_delete, sender=Token)
+def forget_deleted_token(sender, instance, **kwargs):
+    # Logging out and rotating a token both delete it. Other processes
+    # stop accepting it once their cache entry expires
+    forget(instance.key)
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    # Token auth that remembers which user a key belongs to for
+    # TOKEN_CACHE_TTL seconds. Each request then loads the user together
+    # with their player, game and room in one query
+
+    def authenticate_credentials(self, key):
+        user_id = cached_user_id(key)
+        if user_id is None:
+            try:
+                user_id = Token.objects.values_list('user_id', flat=True).get(key=key)
+            except Token.DoesNotExist:
+                raise exceptions.AuthenticationFailed(_('Invalid token.'))
+            remember(key, user_id)
+
+        try:
+            # Loads the player's game and room too, for PlayerContext
+            user = load_player(user_id=user_id).user
+        except Player.DoesNotExist:
+            forget(key)
+            raise exceptions.AuthenticationFailed(_('Invalid token.'))
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(_('User inactive or deleted.'))
+        return user, Token(key=key, user=user)
+
+
+class QueryTokenAuthentication(CachedTokenAuthentication):
+    # Browsers' EventSource cannot send an Authorization header, so the
+    # events stream also accepts the token as ?token=<key>
+    def authenticate(self, request):
+        key = request.query_params.get('token')
+        if not key:
+            return None
+        return self.authenticate_credentials(key)
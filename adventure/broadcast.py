@@ -0,0 +1,57 @@
+import json
+
+from .metrics import timed_call
+
+# Limits of the Pusher HTTP API
+MAX_CHANNELS_PER_TRIGGER = 100
+MAX_EVENTS_PER_BATCH = 10
+
+
+def player_channel(p_uuid):
+    return f'p-channel-{p_uuid}'
+
+
+def chunks(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Broadcast:
+    # Collects the events a view sends to players and delivers them with as
+    # few Pusher calls as possible. Identical events go out as one
+    # multi-channel trigger; events meant for a single channel are sent
+    # together with trigger_batch. With a dispatcher the calls are queued
+    # and sent from its worker threads instead of inline
+
+    def __init__(self, client, dispatcher=None):
+        self.client = client
+        self.dispatcher = dispatcher
+        self.pending = {}
+
+    def send(self, uuids, data, event=u'broadcast'):
+        key = (event, json.dumps(data, sort_keys=True, default=str))
+        channels = self.pending.setdefault(key, (event, data, []))[2]
+        channels.extend(player_channel(p_uuid) for p_uuid in uuids)
+
+    def flush(self):
+        singles = []
+        for event, data, channels in self.pending.values():
+            channels = list(dict.fromkeys(channels))
+            if len(channels) == 1:
+                singles.append({'channel': channels[0], 'name': event, 'data': data})
+                continue
+            for group in chunks(channels, MAX_CHANNELS_PER_TRIGGER):
+                self.call(self.client.trigger, group, event, data)
+        for batch in chunks(singles, MAX_EVENTS_PER_BATCH):
+            if len(batch) == 1:
+                self.call(self.client.trigger, batch[0]['channel'], batch[0]['name'], batch[0]['data'])
+            else:
+                self.call(self.client.trigger_batch, batch)
+        self.pending = {}
+
+    def call(self, func, *args):
+        func = timed_call(func)
+        if self.dispatcher is None:
+            func(*args)
+        else:
+            self.dispatcher.submit(func, *args)
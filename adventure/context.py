@@ -0,0 +1,110 @@
+from functools import wraps
+
+from django.utils.functional import cached_property
+
+from . import engine
+from .maze_cache import get_topology
+from .models import Game, Player, rooms_occupants
+
+# Everything about the requesting player a view needs, fetched in one join
+CONTEXT_RELATIONS = ('user', 'current_game', 'location')
+
+
+def load_player(**filters):
+    return Player.objects.select_related(*CONTEXT_RELATIONS).get(**filters)
+
+
+class PlayerContext:
+    # The requesting player with their user, game and current room, loaded
+    # with one joined query (normally already done by authentication).
+    # Values derived from them are looked up at most once per request.
+    # With GAME_ENGINE=memory a game in progress is read from and moved in
+    # its in-process GameState instead (see adventure/engine.py)
+
+    def __init__(self, user):
+        player = user.player
+        if not Player._meta.get_field('current_game').is_cached(player):
+            player = load_player(pk=user.pk)
+        self.player = player
+        self.user = player.user
+        self.game = player.current_game
+        self._occupants = {}
+        self.state = None
+        if engine.enabled() and self.game is not None and self.game.in_progress:
+            self.state = engine.get_state(self.game)
+        if self.state is not None:
+            self.state.sync(player)
+
+    @cached_property
+    def room(self):
+        room = self.player.location
+        if self.state is not None:
+            # The database may not have caught up with the player's last moves
+            if room is None or room.id != self.player.current_room:
+                room = self.player.room()
+            if room is not None:
+                room.visited = self.state.is_visited(room.id)
+        return room
+
+    @cached_property
+    def topology(self):
+        return get_topology(self.game.id) if self.game else None
+
+    @cached_property
+    def num_players(self):
+        if self.state is not None:
+            return self.state.num_players()
+        return self.game.num_players()
+
+    def occupants(self, room_id):
+        # (usernames, uuids) of everyone else in the room
+        self.load_occupants([room_id])
+        return self._occupants[room_id]
+
+    def load_occupants(self, room_ids):
+        # Looks up the occupants of several rooms with one query
+        missing = [room_id for room_id in room_ids if room_id not in self._occupants]
+        if missing and self.state is not None:
+            self._occupants.update(self.state.occupants(missing, self.user.id))
+        elif missing:
+            self._occupants.update(rooms_occupants(missing, self.user.id))
+
+    def step(self, from_room, to_room, rooms=None):
+        # Player.step, or the same move made in the game's GameState
+        if self.state is not None and self.state.closed:
+            # Written out while this request ran: the game ended, or went
+            # idle. A game still in progress carries on in a fresh state.
+            # Otherwise Player.step reads back that the player has left,
+            # and the view answers that the game is over
+            if Game.objects.filter(id=self.game.id, in_progress=True, finished=False).exists():
+                self.state = engine.get_state(self.game)
+            else:
+                self.state = None
+        if self.state is not None:
+            return self.state.step(self.player, from_room, rooms or [to_room])
+        return self.player.step(from_room, to_room, rooms)
+
+    def other_uuids(self):
+        # UUIDs of everyone else in the player's game
+        if self.state is not None:
+            return self.state.uuids(self.player.uuid)
+        return self.game.get_games_UUIDs(self.player.uuid)
+
+    def visited_room_ids(self):
+        if self.state is not None:
+            return self.state.visited_room_ids()
+        return self.game.visited_room_ids()
+
+    def all_rooms(self):
+        if self.state is not None:
+            return self.state.topology.rooms(set(self.state.visited_room_ids()))
+        return self.game.all_rooms()
+
+
+def with_context(view):
+    # Gives the view request.context, a PlayerContext for the requesting user
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        request.context = PlayerContext(request.user)
+        return view(request, *args, **kwargs)
+    return wrapper
@@ -1,107 +1,291 @@
 import random
-import math
+from array import array
+from collections import deque
+from itertools import permutations
 
-class Room:
-    def __init__(self,i,j):
-        self.i = i # Row
-        self.j = j # Column
-        self.north = True # True == Wall
-        self.east = True # False == Door
-        self.south = True
-        self.west = True
-        self.visited = False
+# Wall bits stored per cell in Maze.walls. A set bit is a wall, a cleared bit is a door
+NORTH = 1
+EAST = 2
+SOUTH = 4
+WEST = 8
+ALL_WALLS = NORTH | EAST | SOUTH | WEST
+
+OPPOSITE = {NORTH: SOUTH, SOUTH: NORTH, EAST: WEST, WEST: EAST}
+
+# Every order the four directions can be tried in. Picking one at random and
+# taking the first unvisited neighbor is (almost) the same as choosing
+# uniformly among them
+DIRECTION_ORDERS = tuple(permutations((NORTH, EAST, SOUTH, WEST)))
+
+
+DEFAULT_ALGORITHM = 'backtracker'
 
-    def __repr__(self):
-        return f"north:{self.north} east:{self.east} south:{self.south} west:{self.west}\n"
 
 class Maze:
-    def __init__(self,columns):
+    def __init__(self, columns, seed=None, algorithm=DEFAULT_ALGORITHM):
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f'Unknown maze algorithm: {algorithm}')
         self.columns = columns
-        self.grid = []
-        self.current = None
-        self.gen_grid()
+        self.algorithm = algorithm
+        self.random = random.Random(seed)
+        # One byte per cell, row by row, holding that cell's wall bits
+        self.walls = bytearray([ALL_WALLS]) * (columns * columns)
         self.gen_maze()
 
-    def gen_grid(self):
-        for i in range(self.columns):
-            for j in range(self.columns):
-                self.grid.append(Room(j,i))
-        self.current = self.grid[0]
+    def __len__(self):
+        return len(self.walls)
+
+    def has_wall(self, index, direction):
+        return bool(self.walls[index] & direction)
+
+    def neighbor(self, index, direction):
+        # Index of the cell on the other side of a wall, or None at the border
+        row, col = divmod(index, self.columns)
+        if direction == NORTH:
+            return index - self.columns if row > 0 else None
+        if direction == SOUTH:
+            return index + self.columns if row < self.columns - 1 else None
+        if direction == EAST:
+            return index + 1 if col < self.columns - 1 else None
+        return index - 1 if col > 0 else None
+
+    def carve(self, index, direction):
+        # Remove the wall between a cell and its neighbor in that direction
+        self.walls[index] &= ~direction
+        self.walls[self.neighbor(index, direction)] &= ~OPPOSITE[direction]
 
     def gen_maze(self):
+        ALGORITHMS[self.algorithm](self)
+
+    def gen_backtracker(self):
+        # Randomized depth-first search (recursive backtracker) run with an
+        # explicit stack so board size is not limited by the recursion limit.
+        # It works on a copy of the grid padded with a ring of visited cells,
+        # which removes every bounds check from the inner loop
+        columns = self.columns
+        total = len(self.walls)
+        width = columns + 2
+        walls = bytearray([ALL_WALLS]) * (width * width)
+        visited = bytearray([1]) * (width * width)
+        for row in range(1, columns + 1):
+            visited[row * width + 1:row * width + 1 + columns] = bytes(columns)
+
+        deltas = {NORTH: -width, SOUTH: width, EAST: 1, WEST: -1}
+        steps = [
+            tuple((deltas[d], ALL_WALLS ^ d, ALL_WALLS ^ OPPOSITE[d]) for d in order)
+            for order in DIRECTION_ORDERS
+        ]
+        # 256 entries so a single random byte picks the order to try directions in
+        steps = (steps * (256 // len(steps) + 1))[:256]
+        # Every step either carves into a new cell or backtracks, so there are
+        # fewer than two steps per cell
+        rolls = iter(self.random.getrandbits(16 * total).to_bytes(2 * total, 'little'))
+
+        cell = width + 1
+        visited[cell] = 1
         stack = []
-        self.current.visited = True
-        next_cell = self.check_neighboor()
-        next_cell.visited = True
-        stack.append(self.current)
-        self.remove_walls(self.current,next_cell)
-        self.current = next_cell
-        def dfs():
-            nonlocal stack
-            if len(stack) == 0:
-                return
-            else:         
-                next_cell = self.check_neighboor()
-                if next_cell:
-                    next_cell.visited = True
-                    stack.append(self.current)
-                    self.remove_walls(self.current,next_cell)
-
-                    self.current = next_cell
-                elif len(stack) > 0:
-                    self.current = stack.pop()
-                dfs()
-        dfs()
-
-    def remove_walls(self,a,b):
-        x = a.i - b.i
-        if x == 1:
-            a.west = False
-            b.east = False
-        elif x == -1:
-            a.east = False
-            b.west = False
-
-        y = a.j - b.j
-        if y == 1:
-            a.north = False
-            b.south = False
-        elif y == -1:
-            a.south = False
-            b.north = False
-
-    def index_finder(self,i,j):
-        if i < 0 or j < 0 or i > self.columns-1 or j > self.columns-1:
-            return None
-        else:
-            return i + j * self.columns
-
-
-    def check_neighboor(self):
-        neighbors = []
-
-        i = self.current.i 
-        j = self.current.j
-
-        top    = self.grid[self.index_finder(i, j - 1)] if self.index_finder(i, j - 1) else None
-        right  = self.grid[self.index_finder(i + 1, j)] if self.index_finder(i + 1, j) else None
-        bottom = self.grid[self.index_finder(i, j + 1)] if self.index_finder(i, j + 1) else None
-        left   = self.grid[self.index_finder(i - 1, j)] if self.index_finder(i - 1, j) else None
-
-        if top and not top.visited:
-            neighbors.append(top)
-        
-        if right and not right.visited:
-            neighbors.append(right)
-        
-        if bottom and not bottom.visited:
-            neighbors.append(bottom)
-        
-        if left and not left.visited:
-            neighbors.append(left)
-        
-        if len(neighbors) > 0:
-            r = math.floor(random.randint(0, len(neighbors)-1))
-            return neighbors[r]
-        else:
-            return None
+        push = stack.append
+        pop = stack.pop
+        while True:
+            for delta, keep, keep_neighbor in steps[next(rolls)]:
+                neighbor = cell + delta
+                if not visited[neighbor]:
+                    visited[neighbor] = 1
+                    walls[cell] &= keep
+                    walls[neighbor] &= keep_neighbor
+                    push(cell)
+                    cell = neighbor
+                    break
+            else:
+                if not stack:
+                    break
+                cell = pop()
+
+        for row in range(columns):
+            start = (row + 1) * width + 1
+            self.walls[row * columns:(row + 1) * columns] = walls[start:start + columns]
+
+    def gen_kruskal(self):
+        # Randomized Kruskal: knock down walls in random order whenever they
+        # separate two cells that are not connected yet (union-find)
+        columns = self.columns
+        parent = list(range(len(self.walls)))
+
+        def find(cell):
+            while parent[cell] != cell:
+                parent[cell] = parent[parent[cell]]
+                cell = parent[cell]
+            return cell
+
+        # Each wall is packed into one int: cell * 2, plus 1 for the south wall
+        total = len(self.walls)
+        edges = [cell * 2 for cell in range(total) if cell % columns < columns - 1]
+        edges += [cell * 2 + 1 for cell in range(total - columns)]
+        self.random.shuffle(edges)
+        for edge in edges:
+            cell, south = divmod(edge, 2)
+            a = find(cell)
+            b = find(cell + columns if south else cell + 1)
+            if a != b:
+                parent[a] = b
+                self.carve(cell, SOUTH if south else EAST)
+
+    def gen_prim(self):
+        # Randomized Prim: grow the maze from one cell, each time connecting a
+        # random frontier cell to a random neighbor already in the maze
+        rand = self.random
+        in_maze = bytearray(len(self.walls))
+        in_frontier = bytearray(len(self.walls))
+        frontier = []
+
+        def add(cell):
+            in_maze[cell] = 1
+            for direction in (NORTH, EAST, SOUTH, WEST):
+                neighbor = self.neighbor(cell, direction)
+                if neighbor is not None and not in_maze[neighbor] and not in_frontier[neighbor]:
+                    in_frontier[neighbor] = 1
+                    frontier.append(neighbor)
+
+        add(0)
+        while frontier:
+            i = rand.randrange(len(frontier))
+            frontier[i], frontier[-1] = frontier[-1], frontier[i]
+            cell = frontier.pop()
+            directions = [
+                d for d in (NORTH, EAST, SOUTH, WEST)
+                if self.neighbor(cell, d) is not None and in_maze[self.neighbor(cell, d)]
+            ]
+            self.carve(cell, rand.choice(directions))
+            add(cell)
+
+    def gen_wilson(self):
+        # Wilson's algorithm: loop-erased random walks from each cell outside
+        # the maze until they hit it. Produces a uniform spanning tree
+        rand = self.random
+        total = len(self.walls)
+        in_maze = bytearray(total)
+        # Last direction the current walk left each cell by. Overwriting it
+        # when the walk revisits a cell is what erases the loop
+        exits = bytearray(total)
+        in_maze[0] = 1
+        directions = (NORTH, EAST, SOUTH, WEST)
+        for start in range(total):
+            if in_maze[start]:
+                continue
+            cell = start
+            while not in_maze[cell]:
+                while True:
+                    direction = rand.choice(directions)
+                    neighbor = self.neighbor(cell, direction)
+                    if neighbor is not None:
+                        break
+                exits[cell] = direction
+                cell = neighbor
+            cell = start
+            while not in_maze[cell]:
+                in_maze[cell] = 1
+                self.carve(cell, exits[cell])
+                cell = self.neighbor(cell, exits[cell])
+
+    def gen_eller(self):
+        self.walls[:] = b''.join(eller_rows(self.columns, self.columns, self.random))
+
+    def open_neighbors(self, index):
+        walls = self.walls[index]
+        if not walls & NORTH:
+            yield index - self.columns
+        if not walls & SOUTH:
+            yield index + self.columns
+        if not walls & EAST:
+            yield index + 1
+        if not walls & WEST:
+            yield index - 1
+
+    def distances_from(self, start=0):
+        # Breadth-first search over the open walls. Returns the distance in
+        # moves from start to every room (a perfect maze has only one route)
+        distances = array('i', [-1]) * len(self.walls)
+        distances[start] = 0
+        queue = deque([start])
+        while queue:
+            index = queue.popleft()
+            for neighbor in self.open_neighbors(index):
+                if distances[neighbor] == -1:
+                    distances[neighbor] = distances[index] + 1
+                    queue.append(neighbor)
+        return distances
+
+    def farthest_from(self, start=0):
+        # The room farthest from start and its distance in moves
+        distances = self.distances_from(start)
+        distance = max(distances)
+        return distances.index(distance), distance
+
+
+def eller_rows(columns, rows, rand):
+    # Eller's algorithm: builds the maze one row at a time, only remembering
+    # which set each cell of the current row belongs to. Yields each row's
+    # wall bytes as soon as the row is finished
+    next_set = 0
+    sets = [None] * columns
+    north_open = [False] * columns
+    for row in range(rows):
+        last_row = row == rows - 1
+        walls = bytearray([ALL_WALLS]) * columns
+        for col in range(columns):
+            if north_open[col]:
+                walls[col] &= ~NORTH
+            if sets[col] is None:
+                sets[col] = next_set
+                next_set += 1
+
+        # Union-find over this row's set labels
+        parent = {}
+
+        def find(label):
+            while parent.get(label, label) != label:
+                label = parent[label]
+            return label
+
+        # Join neighbors in different sets at random (always on the last row,
+        # so the whole maze ends up connected)
+        for col in range(columns - 1):
+            a = find(sets[col])
+            b = find(sets[col + 1])
+            if a != b and (last_row or rand.random() < 0.5):
+                parent[b] = a
+                walls[col] &= ~EAST
+                walls[col + 1] &= ~WEST
+        sets = [find(label) for label in sets]
+
+        if last_row:
+            yield bytes(walls)
+            break
+
+        # Open at least one door south from every set, plus a few at random
+        members = {}
+        for col, label in enumerate(sets):
+            members.setdefault(label, []).append(col)
+        north_open = [False] * columns
+        for cols in members.values():
+            opened = False
+            for col in cols:
+                if rand.random() < 0.5:
+                    north_open[col] = opened = True
+            if not opened:
+                north_open[rand.choice(cols)] = True
+        for col in range(columns):
+            if north_open[col]:
+                walls[col] &= ~SOUTH
+            else:
+                sets[col] = None
+        yield bytes(walls)
+
+
+ALGORITHMS = {
+    'backtracker': Maze.gen_backtracker,
+    'kruskal': Maze.gen_kruskal,
+    'prim': Maze.gen_prim,
+    'wilson': Maze.gen_wilson,
+    'eller': Maze.gen_eller,
+}
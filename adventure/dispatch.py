@@ -0,0 +1,124 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+class Dispatcher:
+    # Bounded in-process queue drained by worker threads, so real-time
+    # notifications are sent after the view has returned instead of inside
+    # the request. When the queue is full a producer waits briefly for room
+    # (back-pressure) and then the oldest queued job is dropped. Failed
+    # sends are retried with exponential backoff and full jitter. Only a
+    # single worker sends jobs in the order they were submitted; with more,
+    # two events for the same channel can arrive the wrong way round
+
+    def __init__(self, max_size=1000, workers=1, retries=3, backoff=0.1, block=0.05):
+        self.max_size = max_size
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.block = block
+        self.jobs = deque()
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.idle = threading.Condition(self.lock)
+        self.active = 0
+        self.threads = []
+        self.counters = {
+            'enqueued': 0, 'sent': 0, 'failed': 0, 'retried': 0, 'dropped': 0,
+            'send_seconds_total': 0.0, 'send_seconds_max': 0.0,
+        }
+
+    def submit(self, func, *args, **kwargs):
+        with self.lock:
+            self._start_workers()
+            if len(self.jobs) >= self.max_size:
+                self.not_full.wait(self.block)
+            if len(self.jobs) >= self.max_size:
+                self.jobs.popleft()
+                self.counters['dropped'] += 1
+            self.jobs.append((func, args, kwargs))
+            self.counters['enqueued'] += 1
+            self.not_empty.notify()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['depth'] = len(self.jobs)
+            stats['in_flight'] = self.active
+        return stats
+
+    def wait_idle(self, timeout=None):
+        # Block until every queued job has been sent (or given up on)
+        with self.lock:
+            return self.idle.wait_for(lambda: not self.jobs and not self.active, timeout)
+
+    def _start_workers(self):
+        while len(self.threads) < self.workers:
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name=f'dispatch-{len(self.threads)}')
+            self.threads.append(thread)
+            thread.start()
+
+    def _work(self):
+        while True:
+            with self.lock:
+                self.not_empty.wait_for(lambda: self.jobs)
+                func, args, kwargs = self.jobs.popleft()
+                self.active += 1
+                self.not_full.notify()
+            try:
+                self._send(func, args, kwargs)
+            finally:
+                with self.lock:
+                    self.active -= 1
+                    if not self.jobs and not self.active:
+                        self.idle.notify_all()
+
+    def _send(self, func, args, kwargs):
+        for attempt in range(self.retries + 1):
+            start = time.perf_counter()
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                if attempt == self.retries:
+                    logger.exception('Giving up on notification after %d attempts', attempt + 1)
+                    with self.lock:
+                        self.counters['failed'] += 1
+                    return
+                with self.lock:
+                    self.counters['retried'] += 1
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+            else:
+                elapsed = time.perf_counter() - start
+                with self.lock:
+                    self.counters['sent'] += 1
+                    self.counters['send_seconds_total'] += elapsed
+                    self.counters['send_seconds_max'] = max(self.counters['send_seconds_max'], elapsed)
+                return
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    # The shared dispatcher, or None when notifications are sent inline
+    global _dispatcher
+    if not settings.BROADCAST_ASYNC:
+        return None
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(
+                max_size=settings.BROADCAST_QUEUE_SIZE,
+                workers=settings.BROADCAST_WORKERS,
+                retries=settings.BROADCAST_RETRIES,
+            )
+    return _dispatcher
@@ -0,0 +1,205 @@
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Case, IntegerField, Value, When
+
+from .maze_cache import get_topology
+from .models import Player, Room
+
+logger = logging.getLogger(__name__)
+
+# Games nobody has played for this many seconds are written out and dropped
+IDLE_SECONDS = 600
+
+_lock = threading.Lock()
+_states = {}
+_flusher = None
+
+
+def enabled():
+    return settings.GAME_ENGINE == 'memory'
+
+
+class PlayerState:
+    __slots__ = ('user_id', 'username', 'uuid', 'room', 'moves')
+
+    def __init__(self, user_id, username, p_uuid, room, moves):
+        self.user_id = user_id
+        self.username = username
+        self.uuid = p_uuid
+        self.room = room
+        self.moves = moves
+
+
+class GameState:
+    # Authoritative copy of one game in progress: where every player is,
+    # their move counts and which rooms have been visited, on top of the
+    # cached maze topology. Moves only touch this object, under its lock,
+    # and the changes are written to the database in batches by flush().
+    # It is built from the database, so after a restart a game carries on
+    # from its last flush
+
+    def __init__(self, game_id, topology):
+        self.game_id = game_id
+        self.topology = topology
+        self.lock = threading.Lock()
+        self.closed = False
+        self.last_used = time.monotonic()
+        self.players = {}
+        # Room id -> ids of the users in it
+        self.occupied = {}
+        # One byte per room, indexed from the game's first room id
+        self.visited = bytearray(len(topology))
+        self.dirty_players = set()
+        self.dirty_rooms = set()
+        rows = Player.objects.filter(game_id=game_id).values_list(
+            'user_id', 'user__username', 'uuid', 'current_room', 'moves')
+        for user_id, username, p_uuid, room, moves in rows:
+            self.players[user_id] = PlayerState(user_id, username, p_uuid, room, moves)
+            self.occupied.setdefault(room, set()).add(user_id)
+        for room_id in Room.objects.filter(game_id=game_id, visited=True).values_list('id', flat=True):
+            self.visited[room_id - topology.min_room_id] = 1
+
+    def sync(self, player):
+        # Copies the player's position and moves onto their Player row
+        with self.lock:
+            self.last_used = time.monotonic()
+            state = self.players.get(player.pk)
+            if state is not None:
+                player.current_room, player.moves = state.room, state.moves
+
+    def step(self, player, from_room, rooms):
+        # Same contract as Player.step: the player only moves if they are
+        # still in from_room. A closed state refuses moves; PlayerContext.step
+        # then moves on to a fresh state or, if the game ended, the database
+        with self.lock:
+            state = self.players.get(player.pk)
+            moved = not self.closed and state is not None and state.room == from_room
+            if moved:
+                self.occupied[from_room].discard(state.user_id)
+                state.room = rooms[-1]
+                state.moves += len(rooms)
+                self.occupied.setdefault(state.room, set()).add(state.user_id)
+                for room_id in rooms:
+                    i = room_id - self.topology.min_room_id
+                    if not self.visited[i]:
+                        self.visited[i] = 1
+                        self.dirty_rooms.add(room_id)
+                self.dirty_players.add(state.user_id)
+            if state is not None:
+                player.current_room, player.moves = state.room, state.moves
+        return moved
+
+    def occupants(self, room_ids, user_id):
+        # Same shape as rooms_occupants: {room_id: (usernames, uuids)}
+        occupants = {}
+        with self.lock:
+            for room_id in room_ids:
+                others = [self.players[other] for other in self.occupied.get(room_id, ()) if other != user_id]
+                occupants[room_id] = ([p.username for p in others], [p.uuid for p in others])
+        return occupants
+
+    def uuids(self, exclude_uuid):
+        with self.lock:
+            return [p.uuid for p in self.players.values() if p.uuid != exclude_uuid]
+
+    def num_players(self):
+        return len(self.players)
+
+    def is_visited(self, room_id):
+        return bool(self.visited[room_id - self.topology.min_room_id])
+
+    def visited_room_ids(self):
+        with self.lock:
+            first = self.topology.min_room_id
+            return [first + i for i, seen in enumerate(self.visited) if seen]
+
+    def flush(self):
+        # Writes every change since the last flush: one UPDATE for the
+        # players and one for the rooms. If it fails the changes stay
+        # pending for the next flush
+        with self.lock:
+            players = [(p.user_id, p.room, p.moves) for p in map(self.players.get, self.dirty_players)]
+            rooms = list(self.dirty_rooms)
+            self.dirty_players.clear()
+            self.dirty_rooms.clear()
+        if not players and not rooms:
+            return
+        try:
+            with transaction.atomic():
+                if players:
+                    # Players already moved out of the game by finish are left alone
+                    Player.objects.filter(pk__in=[p[0] for p in players], game_id=self.game_id).update(
+                        current_room=Case(*[When(pk=pk, then=Value(room)) for pk, room, _ in players],
+                                          output_field=IntegerField()),
+                        moves=Case(*[When(pk=pk, then=Value(moves)) for pk, _, moves in players],
+                                   output_field=IntegerField()))
+                if rooms:
+                    Room.objects.filter(id__in=rooms, visited=False).update(visited=True)
+        except Exception:
+            with self.lock:
+                self.dirty_players.update(p[0] for p in players)
+                self.dirty_rooms.update(rooms)
+            raise
+
+
+def get_state(game):
+    # The GameState of a game in progress, built on first use
+    with _lock:
+        state = _states.get(game.id)
+    if state is not None:
+        return state
+    topology = get_topology(game.id)
+    if topology is None:
+        return None
+    # Built outside the lock so loading one game does not block the others
+    state = GameState(game.id, topology)
+    with _lock:
+        state = _states.setdefault(game.id, state)
+        start_flusher()
+    return state
+
+
+def close(game_id):
+    # Writes out and forgets a game, e.g. before it is finished
+    with _lock:
+        state = _states.pop(game_id, None)
+    if state is not None:
+        with state.lock:
+            state.closed = True
+        state.flush()
+
+
+def flush_all():
+    with _lock:
+        states = list(_states.values())
+    idle_since = time.monotonic() - IDLE_SECONDS
+    for state in states:
+        try:
+            if state.last_used < idle_since:
+                close(state.game_id)
+            else:
+                state.flush()
+        except Exception:
+            logger.exception('Could not write out game %d', state.game_id)
+            connection.close()
+
+
+def start_flusher():
+    # Called with _lock held. Also flushes once more when the process exits
+    global _flusher
+    if _flusher is not None:
+        return
+
+    def run():
+        while True:
+            time.sleep(settings.ENGINE_FLUSH_INTERVAL)
+            flush_all()
+
+    _flusher = threading.Thread(target=run, name='adventure-engine-flush', daemon=True)
+    _flusher.start()
+    atexit.register(flush_all)
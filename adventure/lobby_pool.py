@@ -0,0 +1,68 @@
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+from .create_maze import DEFAULT_ALGORITHM
+from .models import Game
+
+logger = logging.getLogger(__name__)
+
+# Board sizes joinlobby can ask for
+POOL_SIZES = range(2, 11)
+
+_refill_lock = threading.Lock()
+_refilling = set()
+
+
+def pool_depth():
+    return settings.LOBBY_POOL_DEPTH
+
+
+def claim_game(columns, algorithm=DEFAULT_ALGORITHM):
+    # Take a prebuilt game out of the pool. The conditional UPDATE only
+    # succeeds for one caller, so two players can never claim the same game
+    candidates = Game.objects.filter(
+        pooled=True, map_columns=columns, algorithm=algorithm).values_list('id', flat=True)
+    for game_id in candidates[:5]:
+        if Game.objects.filter(id=game_id, pooled=True).update(pooled=False):
+            return Game.objects.get(id=game_id)
+    return None
+
+
+def fill_pool(sizes=POOL_SIZES, depth=None):
+    # Build games until every size has `depth` ready in the pool
+    depth = pool_depth() if depth is None else depth
+    created = 0
+    for columns in sizes:
+        missing = depth - Game.objects.filter(pooled=True, map_columns=columns).count()
+        for _ in range(missing):
+            game = Game(map_columns=columns, in_progress=False, pooled=True)
+            game.create_world()
+            created += 1
+    return created
+
+
+def request_refill(columns):
+    # Top the pool for this size back up on a background thread so the
+    # request that claimed a game does not pay for building its replacement
+    if not pool_depth():
+        return
+    with _refill_lock:
+        if columns in _refilling:
+            return
+        _refilling.add(columns)
+
+    def refill():
+        try:
+            fill_pool(sizes=[columns])
+        except Exception:
+            # The next claim of this size asks for another refill
+            logger.exception('Could not refill the lobby pool for %d columns', columns)
+        finally:
+            with _refill_lock:
+                _refilling.discard(columns)
+            connection.close()
+
+    threading.Thread(target=refill, daemon=True).start()
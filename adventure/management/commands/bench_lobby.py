@@ -0,0 +1,85 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from adventure.create_maze import Maze, NORTH, SOUTH, EAST, WEST
+from adventure.models import Game, Room
+
+
+def legacy_create_world(game):
+    # The original lobby build: one INSERT per room, then a get + UPDATE per
+    # room to wire the exits, then a get per step to find the end
+    room_id = Room.objects.all().aggregate(Max('id'))['id__max']
+    game.min_room_id = 0 if room_id is None else room_id + 1
+    game.save()
+    for id in range(game.min_room_id, game.num_rooms()+game.min_room_id):
+        Room(id=id, game_id=game.id, title=game.generate_title(),
+             description=game.generate_description(), visited=id == 0).save()
+
+    maze = Maze(game.map_columns)
+    for i, walls in enumerate(maze.walls):
+        loc = i + game.min_room_id
+        db_room = Room.objects.get(id=loc)
+        db_room.n = -1 if walls & NORTH else loc - game.map_columns
+        db_room.s = -1 if walls & SOUTH else loc + game.map_columns
+        db_room.e = -1 if walls & EAST else loc + 1
+        db_room.w = -1 if walls & WEST else loc - 1
+        db_room.save()
+
+    furthest_rooms = [Room.objects.get(id=game.min_room_id)]
+    visited_rooms = []
+    further_found = True
+    while further_found:
+        further_found = False
+        for room in furthest_rooms:
+            exits = [r for r in (room.n, room.s, room.e, room.w)
+                     if r > -1 and r not in visited_rooms]
+            if exits:
+                further_found = True
+                visited_rooms.append(room.id)
+                furthest_rooms.remove(room)
+                furthest_rooms.extend(Room.objects.get(id=r) for r in exits)
+            elif len(furthest_rooms) > 1:
+                furthest_rooms.remove(room)
+    furthest_room = furthest_rooms.pop()
+    furthest_room.end = True
+    furthest_room.save()
+
+
+def bulk_create_world(game):
+    game.create_world()
+
+
+class Command(BaseCommand):
+    help = 'Compare lobby creation latency of the legacy and bulk maze builds for every board size'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--runs', type=int, default=5,
+                            help='Lobbies to build per size and strategy')
+        parser.add_argument('--min-columns', type=int, default=2)
+        parser.add_argument('--max-columns', type=int, default=10)
+
+    def handle(self, *args, **options):
+        strategies = [('legacy', legacy_create_world),
+                      ('bulk', bulk_create_world)]
+        self.stdout.write(f"{'columns':>7} {'legacy ms':>10} {'bulk ms':>10} {'speedup':>8}")
+        for columns in range(options['min_columns'], options['max_columns'] + 1):
+            results = {}
+            for name, build in strategies:
+                timings = []
+                for _ in range(options['runs']):
+                    game = Game(map_columns=columns)
+                    start = time.perf_counter()
+                    build(game)
+                    timings.append(time.perf_counter() - start)
+                    self.teardown(game)
+                results[name] = sum(timings) / len(timings) * 1000
+            self.stdout.write(
+                f"{columns:>7} {results['legacy']:>10.2f} {results['bulk']:>10.2f} "
+                f"{results['legacy'] / results['bulk']:>7.1f}x")
+
+    @staticmethod
+    def teardown(game):
+        Room.objects.filter(game_id=game.id).delete()
+        Game.objects.filter(id=game.id).delete()
@@ -0,0 +1,57 @@
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from adventure.create_maze import Maze, ALGORITHMS, NORTH, SOUTH, EAST, WEST
+
+
+def maze_stats(maze):
+    # Count cells by how many doors they have. One door is a dead end, two
+    # doors in a straight line is a corridor, three or more is a junction
+    dead_ends = corridors = junctions = 0
+    for walls in maze.walls:
+        doors = 4 - bin(walls).count('1')
+        if doors == 1:
+            dead_ends += 1
+        elif doors == 2 and walls in (NORTH | SOUTH, EAST | WEST):
+            corridors += 1
+        elif doors >= 3:
+            junctions += 1
+    return dead_ends, corridors, junctions
+
+
+class Command(BaseCommand):
+    help = 'Report generation time, peak memory and shape statistics for every maze algorithm'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 300],
+                            help='Board widths to generate')
+        parser.add_argument('--algorithms', nargs='+', choices=list(ALGORITHMS),
+                            default=list(ALGORITHMS))
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'algorithm':<12} {'size':>6} {'time ms':>10} {'peak KiB':>10} "
+            f"{'dead ends':>10} {'corridors':>10} {'junctions':>10} {'end dist':>9}")
+        for size in options['sizes']:
+            for algorithm in options['algorithms']:
+                start = time.perf_counter()
+                Maze(size, seed=options['seed'], algorithm=algorithm)
+                elapsed = time.perf_counter() - start
+
+                # Peak memory comes from a second run so tracemalloc's
+                # overhead does not skew the timing
+                tracemalloc.start()
+                maze = Maze(size, seed=options['seed'], algorithm=algorithm)
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+
+                cells = len(maze)
+                dead_ends, corridors, junctions = maze_stats(maze)
+                distance = maze.farthest_from(0)[1]
+                self.stdout.write(
+                    f"{algorithm:<12} {size:>6} {elapsed * 1000:>10.1f} {peak / 1024:>10.1f} "
+                    f"{dead_ends / cells:>10.1%} {corridors / cells:>10.1%} "
+                    f"{junctions / cells:>10.1%} {distance:>9}")
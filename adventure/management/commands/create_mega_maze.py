@@ -0,0 +1,23 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from adventure.models import Game
+
+
+class Command(BaseCommand):
+    help = 'Open a lobby on a very large board, streaming the rooms into the database row by row'
+
+    def add_arguments(self, parser):
+        parser.add_argument('columns', type=int, help='Width (and height) of the board')
+        parser.add_argument('--batch-size', type=int, default=5000,
+                            help='Rooms per bulk insert')
+
+    def handle(self, *args, **options):
+        game = Game(map_columns=options['columns'], in_progress=False)
+        start = time.perf_counter()
+        game.stream_world(batch_size=options['batch_size'])
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f'Game {game.id}: {game.num_rooms()} rooms starting at {game.min_room_id} '
+            f'created in {elapsed:.1f}s')
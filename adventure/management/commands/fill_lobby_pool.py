@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from adventure.lobby_pool import POOL_SIZES, fill_pool, pool_depth
+from adventure.reaper import reap
+
+
+class Command(BaseCommand):
+    help = 'Build prebuilt games so every board size has LOBBY_POOL_DEPTH ready to join'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--depth', type=int, default=None,
+                            help='Games to keep per size (defaults to LOBBY_POOL_DEPTH)')
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and top the pool up every interval')
+        parser.add_argument('--interval', type=float, default=2.0,
+                            help='Seconds between top ups with --loop')
+
+    def handle(self, *args, **options):
+        depth = pool_depth() if options['depth'] is None else options['depth']
+        while True:
+            try:
+                self.top_up(depth)
+            except Exception as e:
+                if not options['loop']:
+                    raise
+                # A failed round is retried next interval rather than
+                # stopping the worker
+                self.stderr.write(f'Top up failed: {type(e).__name__}: {e}')
+                connection.close()
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
+
+    def top_up(self, depth):
+        # Finished games are reaped first so recycled boards count
+        # toward the pool before any new ones are built
+        recycled, deleted = reap()
+        if recycled or deleted:
+            self.stdout.write(f'Recycled {recycled} and deleted {deleted} finished games')
+        created = fill_pool(POOL_SIZES, depth)
+        if created:
+            self.stdout.write(f'Built {created} pooled games')
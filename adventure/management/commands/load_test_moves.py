@@ -0,0 +1,84 @@
+import json
+import random
+import statistics
+import time
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from rest_framework.test import APIClient
+
+from adventure.models import Game, Player, Room
+
+USERNAME_PREFIX = 'load-test-'
+
+
+class Command(BaseCommand):
+    help = 'Measure move latency while the number of concurrent games grows'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--games', type=int, nargs='+', default=[1, 10, 50, 100],
+                            help='Numbers of concurrent games to measure')
+        parser.add_argument('--columns', type=int, default=10)
+        parser.add_argument('--moves', type=int, default=500,
+                            help='Moves to time at each step')
+
+    def handle(self, *args, **options):
+        self.cleanup()
+        players = []
+        self.stdout.write(f"{'games':>6} {'rooms':>8} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+        # Nobody shares a room in this test, but make sure no broadcast leaves the box
+        with mock.patch('adventure.api.transport'):
+            try:
+                for target in sorted(options['games']):
+                    while len(players) < target:
+                        players.append(self.start_game(len(players), options['columns']))
+                    timings = [self.timed_move(random.choice(players))
+                               for _ in range(options['moves'])]
+                    timings.sort()
+                    self.stdout.write(
+                        f"{target:>6} {Room.objects.count():>8} "
+                        f"{statistics.median(timings):>8.2f} "
+                        f"{timings[int(len(timings) * 0.95) - 1]:>8.2f} {timings[-1]:>8.2f}")
+            finally:
+                self.cleanup()
+
+    def start_game(self, number, columns):
+        # Load test users are reused between runs rather than deleted
+        user = User.objects.filter(username=f'{USERNAME_PREFIX}{number}').first()
+        if user is None:
+            user = User.objects.create_user(f'{USERNAME_PREFIX}{number}')
+        client = APIClient()
+        client.force_authenticate(user)
+        # Build the game directly so every player gets a board of their own
+        game = Game(map_columns=columns, in_progress=True)
+        game.create_world()
+        user.player.initialize(game.id, game.min_room_id)
+        user.player.save()
+        start = Room.objects.get(id=game.min_room_id)
+        end = Room.objects.get(game=game, end=True)
+        return {'client': client, 'room': start, 'end': end.id}
+
+    def timed_move(self, player):
+        room = player['room']
+        exits = {d: getattr(room, d) for d in 'nsew'}
+        # Never step onto the end room, which would finish the game
+        choices = [d for d, loc in exits.items() if loc != -1 and loc != player['end']]
+        direction = random.choice(choices or ['n'])
+        start = time.perf_counter()
+        response = player['client'].post(
+            '/api/adv/move/', json.dumps({'direction': direction}),
+            content_type='application/json')
+        elapsed = (time.perf_counter() - start) * 1000
+        data = response.json()
+        if not data['error']:
+            player['room'] = Room(**{k: data[k] for k in 'nsew'}, id=data['loc'])
+        return elapsed
+
+    @staticmethod
+    def cleanup():
+        players = Player.objects.filter(user__username__startswith=USERNAME_PREFIX)
+        game_ids = list(players.values_list('game_id', flat=True))
+        Room.objects.filter(game_id__in=game_ids).delete()
+        Game.objects.filter(id__in=game_ids).delete()
+        players.update(current_room=-1, game_id=-1)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from adventure.reaper import CHUNK_SIZE, reap
+
+
+class Command(BaseCommand):
+    help = 'Delete finished games, or recycle them into the lobby pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                            help='Rooms removed per DELETE statement')
+        parser.add_argument('--no-recycle', action='store_true',
+                            help='Delete every finished game instead of refilling the pool with them')
+
+    def handle(self, *args, **options):
+        recycled, deleted = reap(options['chunk_size'], recycle=not options['no_recycle'])
+        self.stdout.write(f'Recycled {recycled} and deleted {deleted} finished games')
@@ -0,0 +1,322 @@
+import json
+import random
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import nullcontext
+from unittest import mock
+
+import requests
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from rest_framework.test import APIClient
+
+from adventure.models import Game, Player
+from adventure.reaper import reap
+
+USERNAME_PREFIX = 'sim-'
+# Seconds a remote request may take before it counts as an error
+HTTP_TIMEOUT = 10
+
+
+class StubTransport:
+    # Stands in for Pusher and counts what would have been sent
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.deliveries = 0
+
+    def trigger(self, channels, event_name, data):
+        with self.lock:
+            self.calls += 1
+            self.deliveries += 1 if isinstance(channels, str) else len(channels)
+
+    def trigger_batch(self, batch):
+        with self.lock:
+            self.calls += 1
+            self.deliveries += len(batch)
+
+
+class HttpClient:
+    # The test client's get and post, sent to a running server instead
+    def __init__(self, base_url, token):
+        self.base_url = base_url.rstrip('/')
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Token {token}'
+
+    def get(self, url, timeout=HTTP_TIMEOUT, **kwargs):
+        return self.session.get(self.base_url + url, timeout=timeout, **kwargs)
+
+    def post(self, url, data, content_type):
+        return self.session.post(self.base_url + url, data=data, timeout=HTTP_TIMEOUT,
+                                 headers={'Content-Type': content_type})
+
+
+class EventListener(threading.Thread):
+    # Holds a player's event stream open for the whole run, as a browser
+    # does, and counts what arrives. The server needs EVENT_TRANSPORT=local.
+    # Streams stay open until the command exits
+    def __init__(self, client, stats):
+        super().__init__(daemon=True)
+        self.client = client
+        self.stats = stats
+        self.events = 0
+
+    def run(self):
+        try:
+            # A quiet stream only sends a keepalive every 15 seconds
+            response = self.client.get('/api/adv/events/', stream=True, timeout=(HTTP_TIMEOUT, None))
+            if response.status_code != 200:
+                raise ValueError(f'status {response.status_code}')
+            for line in response.iter_lines():
+                self.events += line.startswith(b'event:')
+        except Exception as e:
+            self.stats.failed('events', e)
+
+
+class Stats:
+    # Latency and query counts per endpoint, shared by the client threads
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.results = defaultdict(lambda: {'timings': [], 'queries': [], 'errors': 0})
+        self.exceptions = Counter()
+
+    def record(self, endpoint, elapsed, queries, ok):
+        with self.lock:
+            result = self.results[endpoint]
+            result['timings'].append(elapsed * 1000)
+            result['queries'].append(queries)
+            if not ok:
+                result['errors'] += 1
+
+    def failed(self, endpoint, exception):
+        with self.lock:
+            self.exceptions[f'{endpoint}: {type(exception).__name__}: {exception}'] += 1
+
+
+def percentile(timings, p):
+    # Nearest rank on an already sorted list
+    return timings[max(0, int(round(p / 100 * len(timings))) - 1)]
+
+
+def solve(maze, start):
+    # Directions from start to the end room, found by breadth-first search
+    # over the maze the join response gives every client
+    rooms = {room['id']: room for room in maze}
+    end = next(room['id'] for room in maze if room['end'])
+    came_from = {start: None}
+    queue = deque([start])
+    while queue:
+        room_id = queue.popleft()
+        if room_id == end:
+            break
+        for direction in 'nsew':
+            next_id = rooms[room_id][direction]
+            if next_id != -1 and next_id not in came_from:
+                came_from[next_id] = (room_id, direction)
+                queue.append(next_id)
+    path = []
+    while came_from[end] is not None:
+        end, direction = came_from[end]
+        path.append(direction)
+    return path[::-1]
+
+
+class SimulatedPlayer:
+    # One synthetic client using the real routes with its own auth token
+
+    def __init__(self, client, columns, strategy, stats):
+        self.client = client
+        self.columns = columns
+        self.strategy = strategy
+        self.stats = stats
+        self.in_game = False
+        self.exits = {}
+        self.path = []
+        self.wins = 0
+
+    def request(self, endpoint, method, url, body=None):
+        # The test client re-raises a view's exception; that is a server
+        # error as far as the client is concerned
+        # Queries can only be counted when the views run in this process
+        remote = isinstance(self.client, HttpClient)
+        with nullcontext([]) if remote else CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            try:
+                if method == 'get':
+                    response = self.client.get(url)
+                else:
+                    response = self.client.post(url, json.dumps(body), content_type='application/json')
+            except Exception as e:
+                response = None
+                self.stats.failed(endpoint, e)
+            elapsed = time.perf_counter() - start
+        ok = response is not None and response.status_code == 200
+        self.stats.record(endpoint, elapsed, None if remote else len(queries), ok)
+        return response.json() if ok else {}
+
+    def join(self):
+        data = self.request('join', 'get', f'/api/adv/join/?columns={self.columns}')
+        if 'current_room' not in data:
+            return
+        self.in_game = True
+        self.exits = {d: data['current_room'][d] for d in 'nsew'}
+        if self.strategy == 'solver':
+            self.path = solve(data['maze'], data['current_room']['loc'])
+
+    def init(self):
+        self.request('init', 'get', '/api/adv/init/')
+
+    def act(self, say_ratio, shout_ratio):
+        if not self.in_game:
+            return self.join()
+        roll = random.random()
+        if roll < say_ratio:
+            return self.request('say', 'post', '/api/adv/say/', {'message': 'hello'})
+        if roll < say_ratio + shout_ratio:
+            return self.request('shout', 'post', '/api/adv/shout/', {'message': 'HELLO'})
+        self.move()
+
+    def move(self):
+        if self.path:
+            direction = self.path[0]
+        else:
+            direction = random.choice([d for d, loc in self.exits.items() if loc != -1] or ['n'])
+        data = self.request('move', 'post', '/api/adv/move/', {'direction': direction})
+        if data.get('in_progress') is False:
+            if data.get('message') == 'Game has not started yet':
+                self.init()
+            else:
+                # Someone (maybe this player) reached the end
+                self.wins += data.get('error') is False
+                self.in_game = False
+                self.path = []
+        elif not data.get('error'):
+            self.exits = {d: data[d] for d in 'nsew'}
+            if self.path:
+                self.path.pop(0)
+
+
+class Command(BaseCommand):
+    help = 'Play whole games through the API and report latency and queries per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--players', type=int, default=20)
+        parser.add_argument('--per-game', type=int, default=4,
+                            help='Players that join each lobby before it is started')
+        parser.add_argument('--columns', type=int, default=5)
+        parser.add_argument('--rounds', type=int, default=50,
+                            help='Actions each player takes after the games start')
+        parser.add_argument('--strategy', choices=['random', 'solver'], default='random',
+                            help='Random walk, or follow the shortest route to the end')
+        parser.add_argument('--say', type=float, default=0.05, help='Share of actions that are say')
+        parser.add_argument('--shout', type=float, default=0.02, help='Share of actions that are shout')
+        parser.add_argument('--concurrency', type=int, default=1,
+                            help='Threads sending requests at the same time')
+        parser.add_argument('--seed', type=int, default=None)
+        parser.add_argument('--url', default=None,
+                            help='Send the requests to a running server, e.g. http://localhost:8000, '
+                                 'instead of calling the views in this process')
+        parser.add_argument('--listeners', type=int, default=0,
+                            help='Players that also hold their event stream open (needs --url)')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        stats = Stats()
+        transport = StubTransport()
+        self.cleanup()
+        clients = [self.client(user, options['url']) for user in self.users(options['players'])]
+        listeners = [EventListener(client, stats) for client in clients[:options['listeners']]]
+        with mock.patch('adventure.api.transport', transport):
+            try:
+                players = [SimulatedPlayer(client, options['columns'], options['strategy'], stats)
+                           for client in clients]
+                for listener in listeners:
+                    listener.start()
+                started = time.perf_counter()
+                # Fill each lobby in turn, then its first player starts the game
+                for i in range(0, len(players), options['per_game']):
+                    group = players[i:i + options['per_game']]
+                    for player in group:
+                        player.join()
+                    group[0].init()
+                self.run(players, options)
+                elapsed = time.perf_counter() - started
+            finally:
+                self.cleanup()
+        self.report(stats, elapsed, transport, sum(player.wins for player in players),
+                    sum(listener.events for listener in listeners), options['url'])
+
+    def run(self, players, options):
+        def play(share):
+            try:
+                for _ in range(options['rounds']):
+                    for player in share:
+                        player.act(options['say'], options['shout'])
+            finally:
+                connection.close()
+
+        workers = max(1, options['concurrency'])
+        threads = [threading.Thread(target=play, args=(players[i::workers],)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    @staticmethod
+    def client(user, url):
+        if url:
+            return HttpClient(url, user.auth_token.key)
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+        return client
+
+    def report(self, stats, elapsed, transport, wins, events, url):
+        self.stdout.write(f"{'endpoint':<8} {'count':>6} {'errors':>6} {'p50 ms':>8} {'p95 ms':>8} "
+                          f"{'p99 ms':>8} {'max ms':>8} {'queries':>8} {'max q':>6}")
+        total = 0
+        for endpoint in ('join', 'init', 'move', 'say', 'shout'):
+            result = stats.results.get(endpoint)
+            if not result:
+                continue
+            timings = sorted(result['timings'])
+            total += len(timings)
+            if url:
+                queries = f"{'-':>8} {'-':>6}"
+            else:
+                queries = f"{sum(result['queries']) / len(timings):>8.2f} {max(result['queries']):>6}"
+            self.stdout.write(
+                f"{endpoint:<8} {len(timings):>6} {result['errors']:>6} "
+                f"{percentile(timings, 50):>8.2f} {percentile(timings, 95):>8.2f} "
+                f"{percentile(timings, 99):>8.2f} {timings[-1]:>8.2f} {queries}")
+        summary = f'{total} requests in {elapsed:.2f}s ({total / elapsed:.1f} req/s), {wins} games won'
+        if url:
+            # Notifications are sent by the server, only streamed ones are seen
+            self.stdout.write(f'{summary}, {events} events streamed')
+        else:
+            self.stdout.write(f'{summary}, {transport.calls} notification calls '
+                              f'to {transport.deliveries} channels')
+        for failure, count in stats.exceptions.most_common():
+            self.stderr.write(f'{count} x {failure}')
+
+    @staticmethod
+    def users(count):
+        # Synthetic users are reused between runs rather than deleted
+        users = []
+        for number in range(count):
+            user = User.objects.filter(username=f'{USERNAME_PREFIX}{number}').first()
+            if user is None:
+                user = User.objects.create_user(f'{USERNAME_PREFIX}{number}')
+            users.append(user)
+        return users
+
+    @staticmethod
+    def cleanup():
+        # End every game a synthetic player is in and reap them
+        game_ids = Player.objects.filter(user__username__startswith=USERNAME_PREFIX).exclude(
+            game_id=-1).values_list('game_id', flat=True)
+        for game in Game.objects.filter(id__in=set(game_ids)):
+            game.finish(started=False)
+        reap()
@@ -0,0 +1,203 @@
+import json
+import math
+import threading
+from array import array
+from collections import OrderedDict, deque, namedtuple
+
+from django.conf import settings
+
+from .create_maze import NORTH, SOUTH, EAST, WEST
+from .models import Room
+
+# The parts of a room that never change once its maze is generated
+CachedRoom = namedtuple('CachedRoom', ['id', 'title', 'description', 'end', 'n', 's', 'e', 'w'])
+
+
+# Next hops stored in MazeTopology.hints index into DIRECTIONS
+DIRECTIONS = 'nsew'
+NO_HINT = 255
+
+
+class MazeTopology:
+    # Read-only copy of one game's maze, loaded with a single query.
+    # Exits are kept in a flat int array, four per room (n, s, e, w),
+    # alongside each room's distance to the end and the next hop toward it
+
+    def __init__(self, game_id):
+        rows = Room.objects.filter(game_id=game_id).order_by('id').values_list(
+            'id', 'title', 'description', 'end', 'n', 's', 'e', 'w', 'distance')
+        self.game_id = game_id
+        self.min_room_id = None
+        self.end_id = None
+        self.titles = []
+        self.descriptions = []
+        self.exits = array('i')
+        self.distances = array('i')
+        self._compact_json = None
+        for room_id, title, description, end, n, s, e, w, distance in rows:
+            if self.min_room_id is None:
+                self.min_room_id = room_id
+            if end:
+                self.end_id = room_id
+            self.titles.append(title)
+            self.descriptions.append(description)
+            self.exits.extend((n, s, e, w))
+            self.distances.append(distance)
+        self.hints = self.next_hops()
+
+    def next_hops(self):
+        # The exit leading one step closer to the end, for every room
+        hints = bytearray([NO_HINT]) * len(self)
+        distances = self.distances
+        for i in range(len(self)):
+            if distances[i] <= 0:
+                continue
+            for d in range(4):
+                next_id = self.exits[i * 4 + d]
+                if next_id != -1 and distances[next_id - self.min_room_id] == distances[i] - 1:
+                    hints[i] = d
+                    break
+        return hints
+
+    def __len__(self):
+        return len(self.titles)
+
+    @property
+    def columns(self):
+        return int(math.sqrt(len(self)))
+
+    @property
+    def etag(self):
+        # A game's maze never changes and game ids are never reused
+        return f'"maze-{self.game_id}"'
+
+    def __contains__(self, room_id):
+        return self.min_room_id is not None and 0 <= room_id - self.min_room_id < len(self)
+
+    def exit(self, room_id, direction):
+        return self.exits[(room_id - self.min_room_id) * 4 + DIRECTIONS.index(direction)]
+
+    def room(self, room_id):
+        if room_id not in self:
+            return None
+        i = room_id - self.min_room_id
+        n, s, e, w = self.exits[i * 4:i * 4 + 4]
+        return CachedRoom(room_id, self.titles[i], self.descriptions[i],
+                          room_id == self.end_id, n, s, e, w)
+
+    def distance(self, room_id):
+        # Moves from room_id to the end, or None when the maze has no distances
+        distance = self.distances[room_id - self.min_room_id]
+        return None if distance == -1 else distance
+
+    def hint(self, room_id):
+        # Direction of the next step toward the end, or None
+        hint = self.hints[room_id - self.min_room_id]
+        return None if hint == NO_HINT else DIRECTIONS[hint]
+
+    def walk(self, start, directions):
+        # Follow directions from start, stopping early at a wall or the end
+        # room. Returns the rooms entered and 'wall', 'end' or None
+        rooms = []
+        room_id = start
+        for direction in directions:
+            room_id = self.exit(room_id, direction)
+            if room_id == -1:
+                return rooms, 'wall'
+            rooms.append(room_id)
+            if room_id == self.end_id:
+                return rooms, 'end'
+        return rooms, None
+
+    def path(self, start, target):
+        # Directions of the shortest route from start to target (breadth
+        # first search; the maze is a tree so it is also the only route)
+        came_from = {start: None}
+        queue = deque([start])
+        while queue:
+            room_id = queue.popleft()
+            if room_id == target:
+                break
+            for direction in DIRECTIONS:
+                next_id = self.exit(room_id, direction)
+                if next_id != -1 and next_id not in came_from:
+                    came_from[next_id] = (room_id, direction)
+                    queue.append(next_id)
+        if target not in came_from:
+            return None
+        directions = []
+        while came_from[target] is not None:
+            target, direction = came_from[target]
+            directions.append(direction)
+        return directions[::-1]
+
+    def rooms(self, visited_ids):
+        # The maze in the same shape model_to_dict gives, without loading rooms
+        exits = self.exits
+        return [
+            {
+                'id': room_id,
+                'title': self.titles[i],
+                'description': self.descriptions[i],
+                'visited': room_id in visited_ids,
+                'end': room_id == self.end_id,
+                'n': exits[i * 4],
+                's': exits[i * 4 + 1],
+                'e': exits[i * 4 + 2],
+                'w': exits[i * 4 + 3],
+            }
+            for i, room_id in enumerate(range(self.min_room_id, self.min_room_id + len(self)))
+        ]
+
+    def compact_json(self):
+        # The static part of the maze, encoded once. Rooms are listed in id
+        # order; doors is a bitmask per room (n=1, e=2, s=4, w=8, set means
+        # open) and titles/descriptions index into a shared string table
+        if self._compact_json is None:
+            strings = {}
+            doors = []
+            for i in range(len(self)):
+                n, s, e, w = self.exits[i * 4:i * 4 + 4]
+                doors.append((n != -1 and NORTH) | (e != -1 and EAST) |
+                             (s != -1 and SOUTH) | (w != -1 and WEST))
+            titles = [strings.setdefault(t, len(strings)) for t in self.titles]
+            descriptions = [strings.setdefault(d, len(strings)) for d in self.descriptions]
+            self._compact_json = json.dumps({
+                'error': False,
+                'game_id': self.game_id,
+                'columns': self.columns,
+                'min_room_id': self.min_room_id,
+                'end': self.end_id,
+                'doors': doors,
+                'strings': list(strings),
+                'titles': titles,
+                'descriptions': descriptions,
+            }, separators=(',', ':')).encode()
+        return self._compact_json
+
+
+_lock = threading.Lock()
+_topologies = OrderedDict()
+
+
+def get_topology(game_id):
+    with _lock:
+        topology = _topologies.get(game_id)
+        if topology is not None:
+            _topologies.move_to_end(game_id)
+            return topology
+
+    # Built outside the lock so one slow load does not block other games
+    topology = MazeTopology(game_id)
+    if not len(topology):
+        return None
+    with _lock:
+        _topologies[game_id] = topology
+        while len(_topologies) > settings.MAZE_CACHE_SIZE:
+            _topologies.popitem(last=False)
+    return topology
+
+
+def invalidate(game_id):
+    with _lock:
+        _topologies.pop(game_id, None)
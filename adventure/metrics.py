@@ -0,0 +1,182 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.http import Http404, HttpResponse
+
+# Upper bounds of the histogram buckets, Prometheus style
+SECONDS_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+METRICS = {
+    'adventure_request_seconds': ('Wall time of each API view', SECONDS_BUCKETS),
+    'adventure_db_seconds': ('Time each API view spent in database queries', SECONDS_BUCKETS),
+    'adventure_db_queries': ('Database queries made by each API view', COUNT_BUCKETS),
+    'adventure_pusher_calls': ('Notification calls made by each API view', COUNT_BUCKETS),
+    'adventure_pusher_seconds': ('Latency of each notification call', SECONDS_BUCKETS),
+    'adventure_response_bytes': ('Size of each API response body', BYTES_BUCKETS),
+    'adventure_generation_seconds': ('Time spent in each phase of building a maze', SECONDS_BUCKETS),
+}
+
+_lock = threading.Lock()
+# Metric name -> {label values: Histogram}
+_histograms = {name: {} for name in METRICS}
+# The RequestMetrics of the request this thread is serving, if any
+_current = threading.local()
+
+
+def enabled():
+    return settings.METRICS_ENABLED
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket plus one for values above the last bound
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def observe(name, value, **labels):
+    key = tuple(sorted(labels.items()))
+    with _lock:
+        histogram = _histograms[name].get(key)
+        if histogram is None:
+            histogram = _histograms[name][key] = Histogram(METRICS[name][1])
+        histogram.observe(value)
+
+
+def reset():
+    with _lock:
+        for histograms in _histograms.values():
+            histograms.clear()
+
+
+def format_labels(labels, **extra):
+    pairs = list(labels) + sorted(extra.items())
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+
+def render():
+    # The Prometheus text exposition format
+    lines = []
+    with _lock:
+        for name, (help_text, buckets) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} histogram')
+            for labels, histogram in sorted(_histograms[name].items()):
+                cumulative = 0
+                for bound, count in zip(buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels, le=bound)} {cumulative}')
+                lines.append(f'{name}_bucket{format_labels(labels, le="+Inf")} {histogram.count}')
+                lines.append(f'{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{format_labels(labels)} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def span(phase):
+    # Times one phase of a larger piece of work, e.g. building a maze
+    if not enabled():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe('adventure_generation_seconds', time.perf_counter() - start, phase=phase)
+
+
+class RequestMetrics:
+    def __init__(self):
+        self.view = None
+        self.db_seconds = 0
+        self.queries = 0
+        self.pusher_calls = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        # connection.execute_wrapper hook, run around every query
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_seconds += time.perf_counter() - start
+            self.queries += 1
+
+
+def current():
+    return getattr(_current, 'metrics', None)
+
+
+def timed_call(func):
+    # Wraps a notification call made while serving a view so its latency is
+    # recorded wherever it ends up running, inline or on a dispatcher thread
+    request_metrics = current()
+    if request_metrics is None:
+        return func
+    request_metrics.pusher_calls += 1
+    view = request_metrics.view
+
+    def call(*args):
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            observe('adventure_pusher_seconds', time.perf_counter() - start, view=view)
+    return call
+
+
+class MetricsMiddleware:
+    # Records wall time, database time, query count, notification calls and
+    # response size of every API view, when METRICS_ENABLED is set
+
+    def __init__(self, get_response):
+        if not enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        request_metrics = RequestMetrics()
+        _current.metrics = request_metrics
+        start = time.perf_counter()
+        try:
+            with connection.execute_wrapper(request_metrics):
+                response = self.get_response(request)
+        finally:
+            _current.metrics = None
+        view = request_metrics.view
+        if view is None:
+            return response
+        observe('adventure_request_seconds', time.perf_counter() - start, view=view)
+        observe('adventure_db_seconds', request_metrics.db_seconds, view=view)
+        observe('adventure_db_queries', request_metrics.queries, view=view)
+        observe('adventure_pusher_calls', request_metrics.pusher_calls, view=view)
+        if not response.streaming:
+            observe('adventure_response_bytes', len(response.content), view=view)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Only the game API is measured, labelled with the view's name
+        if view_func.__module__ == 'adventure.api':
+            current().view = view_func.__name__
+
+
+def metrics_view(request):
+    # Every worker process keeps its own histograms
+    if not enabled():
+        raise Http404
+    return HttpResponse(render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0006_auto_20190801_1000'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='algorithm',
+            field=models.CharField(choices=[('backtracker', 'backtracker'), ('kruskal', 'kruskal'), ('prim', 'prim'), ('wilson', 'wilson'), ('eller', 'eller')], default='backtracker', max_length=20),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0007_game_algorithm'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='pooled',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
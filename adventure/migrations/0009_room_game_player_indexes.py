@@ -0,0 +1,37 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def link_rooms_to_games(apps, schema_editor):
+    # Rooms used to belong to a game only through its id range
+    Game = apps.get_model('adventure', 'Game')
+    Room = apps.get_model('adventure', 'Room')
+    for game in Game.objects.all():
+        last_room_id = game.min_room_id + game.map_columns * game.map_columns - 1
+        Room.objects.filter(id__gte=game.min_room_id, id__lte=last_room_id).update(game=game)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0008_game_pooled'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='game',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='rooms', to='adventure.Game'),
+        ),
+        migrations.RunPython(link_rooms_to_games, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['game_id', 'current_room'], name='adventure_p_game_id_563ede_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='player',
+            index=models.Index(fields=['current_room'], name='adventure_p_current_2bb57c_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 14:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0009_room_game_player_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='finished',
+            field=models.BooleanField(db_index=True, default=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 15:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0010_game_finished'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='room',
+            name='distance',
+            field=models.IntegerField(default=-1),
+        ),
+    ]
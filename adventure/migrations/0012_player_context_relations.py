@@ -0,0 +1,24 @@
+# Generated by Django 2.2.28 on 2026-10-18 09:59
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0011_room_distance'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='player',
+            name='current_game',
+            field=models.ForeignObject(from_fields=('game_id',), null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='adventure.Game', to_fields=('id',)),
+        ),
+        migrations.AddField(
+            model_name='player',
+            name='location',
+            field=models.ForeignObject(from_fields=('current_room',), null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='adventure.Room', to_fields=('id',)),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 2.2.28 on 2026-10-18 10:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('adventure', '0012_player_context_relations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='game',
+            name='reaping_since',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
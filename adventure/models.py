@@ -1,13 +1,40 @@
-from django.db import models
+from django.db import connection, models, transaction
 from django.contrib.auth.models import User
 from django.db.models.signals import post_save
 from django.forms.models import model_to_dict
 from django.dispatch import receiver
 from rest_framework.authtoken.models import Token
 import uuid
+import queue
+import random
+import threading
+from contextlib import contextmanager
 from random import choice, randint
-from .create_maze import Maze
-from django.db.models import Max
+from .create_maze import Maze, NORTH, SOUTH, EAST, WEST, ALGORITHMS, DEFAULT_ALGORITHM, eller_rows
+from django.db.models import F, Max
+from .metrics import span
+
+
+# Postgres advisory lock key held while a builder reserves and inserts rooms
+RESERVE_ROOMS_LOCK = 7310
+_reserve_lock = threading.Lock()
+
+
+@contextmanager
+def reserving_rooms():
+    # A transaction during which this builder alone may reserve room ids.
+    # Builders in other threads and processes (refill threads, the pool
+    # worker, joinlobby, create_mega_maze) wait their turn
+    with _reserve_lock, transaction.atomic():
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [RESERVE_ROOMS_LOCK])
+        elif connection.vendor == 'sqlite':
+            # Take the write lock before reading. A read lock can't be
+            # upgraded while another connection commits its rooms
+            with connection.cursor() as cursor:
+                cursor.execute('UPDATE adventure_game SET id = id WHERE 0')
+        yield
 
 
 class Game(models.Model):
@@ -15,113 +42,154 @@ class Game(models.Model):
     # stackoverflow on writing a custom value validator if we want to implement size limiting https://stackoverflow.com/questions/849142/how-to-limit-the-maximum-value-of-a-numeric-field-in-a-django-model
     map_columns = models.PositiveIntegerField(default=5)
     min_room_id = models.IntegerField(default=0)
+    algorithm = models.CharField(max_length=20, default=DEFAULT_ALGORITHM,
+                                 choices=[(name, name) for name in ALGORITHMS])
+    # Prebuilt games waiting in the lobby pool are hidden until a player claims one
+    pooled = models.BooleanField(default=False, db_index=True)
+    # Finished games are hidden and left for the reaper (adventure/reaper.py)
+    # to delete or recycle, so nobody's request pays for the teardown
+    finished = models.BooleanField(default=False, db_index=True)
+    # Set by the reaper that claimed this finished game, so no other one
+    # recycles or deletes it at the same time
+    reaping_since = models.DateTimeField(null=True, blank=True)
+
+    def create_world(self):
+        # Build the whole maze in memory, then write every room with one bulk
+        # insert so lobby creation costs a handful of queries instead of 3 per room
+        with span('generate_rooms'):
+            rooms = self.generate_rooms()
+        with span('generate_maze'):
+            maze = Maze(self.map_columns, algorithm=self.algorithm)
+            self.generate_maze(rooms, maze)
+        with span('generate_end'):
+            self.generate_end(rooms, maze)
+        with span('bulk_create'):
+            Room.objects.bulk_create(rooms)
+        return rooms
+
+    def stream_world(self, batch_size=5000):
+        # For boards too big to hold in memory. Eller's algorithm generates
+        # one row at a time on a producer thread while this thread bulk
+        # inserts finished batches, so memory stays proportional to the width
+        # of the board and generation overlaps with the database writes.
+        # Finding the farthest room needs the whole maze, so the end is
+        # placed in the bottom right corner instead
+        self.algorithm = 'eller'
+        batches = queue.Queue(maxsize=2)
+        stop = threading.Event()
+
+        def produce():
+            try:
+                batch = []
+                # The bottom right corner
+                end_id = self.min_room_id + self.num_rooms() - 1
+                rows = eller_rows(self.map_columns, self.map_columns, random.Random())
+                for row, row_walls in enumerate(rows):
+                    # The consumer failed, so nobody will take the rest
+                    if stop.is_set():
+                        return
+                    first_id = self.min_room_id + row * self.map_columns
+                    for col, walls in enumerate(row_walls):
+                        room = Room(
+                            id=first_id + col,
+                            game_id=self.id,
+                            title=self.generate_title(),
+                            description=self.generate_description(),
+                            visited=first_id + col == self.min_room_id
+                        )
+                        room.end = room.id == end_id
+                        self.wire_room(room, walls)
+                        batch.append(room)
+                    if len(batch) >= batch_size:
+                        put(batch)
+                        batch = []
+                if batch:
+                    put(batch)
+                put(None)
+            except Exception as e:
+                put(e)
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    batches.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        self.reserve_rooms()
+        producer = threading.Thread(target=produce, daemon=True)
+        producer.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is None:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                Room.objects.bulk_create(batch)
+        finally:
+            stop.set()
+            producer.join()
+
+    def reserve_rooms(self):
+        # Takes the ids after both the highest room and the highest range
+        # another game has reserved, and records the range on this game in
+        # one short transaction. Rooms can then be written at leisure
+        with reserving_rooms():
+            room_id = Room.objects.aggregate(Max('id'))['id__max']
+            reserved = Game.objects.exclude(id=self.id).aggregate(
+                end=Max(F('min_room_id') + F('map_columns') * F('map_columns'),
+                        output_field=models.IntegerField()))['end']
+            self.min_room_id = max(-1 if room_id is None else room_id, (reserved or 0) - 1) + 1
+            self.save()
 
     def generate_rooms(self):
-        room_id = Room.objects.all().aggregate(Max('id'))['id__max']
-        if room_id is None:
-            self.min_room_id = 0
-        else:
-            self.min_room_id = room_id + 1
-        self.save()
+        self.reserve_rooms()
         total_rooms = self.num_rooms()
-        
-        for id in range(self.min_room_id, total_rooms+self.min_room_id):
-            if id == 0:
-                new_room = Room(
-                    id=id,
-                    title=self.generate_title(),
-                    description=self.generate_description(),
-                    visited=True
-                )
-                new_room.save()
-            else:
-                new_room = Room(
-                    id=id,
-                    title=self.generate_title(),
-                    description=self.generate_description()
-                )
-                new_room.save()
-
-    def generate_maze(self):
-
-        def room_north(loc):
-            return loc - self.map_columns
-        def room_south(loc):
-            return loc + self.map_columns
-        def room_east(loc):
-            return loc + 1
-        def room_west(loc):
-            return loc - 1
-
-        maze = Maze(self.map_columns)
-        i = 0
-        for room in maze.grid:
-            db_room = Room.objects.get(id=i+self.min_room_id)
-            db_room.n = -1 if room.north else room_north(i+self.min_room_id)
-            db_room.s = -1 if room.south else room_south(i+self.min_room_id)
-            db_room.e = -1 if room.east else room_east(i+self.min_room_id)
-            db_room.w = -1 if room.west else room_west(i+self.min_room_id)
-            db_room.save()
-            i += 1
-    
-    def generate_end(self):
-        # Get starting room
-        first_room = Room.objects.get(id=self.min_room_id)
-        # The furthest rooms will be stored in this array
-        furthest_rooms = [first_room]
-        # All visited rooms will be stored in this array
-        visited_rooms = []
-        # Each time a further room is found the loop will run again
-        further_found = True
-
-        # While further rooms are being found
-        while further_found:
-            further_found = False
-            # For each room
-            for room in furthest_rooms:
-                n = room.n > -1 and room.n not in visited_rooms
-                s = room.s > -1 and room.s not in visited_rooms
-                e = room.e > -1 and room.e not in visited_rooms
-                w = room.w > -1 and room.w not in visited_rooms
-
-                # If there's a further room that has not been visited
-                if n or s or e or w:
-
-                    # Add this room to visited_rooms
-                    # Remove it from furthest rooms (because a further room was found)
-                    further_found = True
-                    visited_rooms.append(room.id)
-                    furthest_rooms.remove(room)
-                    # Add any further rooms to furthest_rooms
-                    if n:
-                        applicable_room = Room.objects.get(id=room.n)
-                        furthest_rooms.append(applicable_room)
-                    if s:
-                        applicable_room = Room.objects.get(id=room.s)
-                        furthest_rooms.append(applicable_room)
-                    if e:
-                        applicable_room = Room.objects.get(id=room.e)
-                        furthest_rooms.append(applicable_room)
-                    if w:
-                        applicable_room = Room.objects.get(id=room.w)
-                        furthest_rooms.append(applicable_room)
-                # If this room has no n, e, s, or w neighbor that has NOT been visited
-                # And if there's more than one room in the furthest_rooms list
-                elif len(furthest_rooms) > 1:
-                    # Then remove it
-                    furthest_rooms.remove(room)
-        
-        # Set the end column to True on the furthest room
-        furthest_room = furthest_rooms.pop()
-        furthest_room.end = True
-        furthest_room.save()
+
+        return [
+            Room(
+                id=id,
+                game_id=self.id,
+                title=self.generate_title(),
+                description=self.generate_description(),
+                visited=id == self.min_room_id
+            )
+            for id in range(self.min_room_id, total_rooms+self.min_room_id)
+        ]
+
+    def generate_maze(self, rooms, maze):
+        for room, walls in zip(rooms, maze.walls):
+            self.wire_room(room, walls)
+
+    def wire_room(self, room, walls):
+        # Point each doorway at the neighboring room's id, -1 means a wall
+        room.n = -1 if walls & NORTH else room.id - self.map_columns
+        room.s = -1 if walls & SOUTH else room.id + self.map_columns
+        room.e = -1 if walls & EAST else room.id + 1
+        room.w = -1 if walls & WEST else room.id - 1
+
+    def generate_end(self, rooms, maze):
+        # The room farthest from the start becomes the end of the maze. Every
+        # room also stores its distance to the end, which hints are read from
+        furthest_index, distance = maze.farthest_from(0)
+        rooms[furthest_index].end = True
+        for room, to_end in zip(rooms, maze.distances_from(furthest_index)):
+            room.distance = to_end
+        return distance
 
     def all_rooms(self):
-        last_room_id = self.min_room_id+self.num_rooms()-1
-        room_list = list(Room.objects.filter(
-            id__gte=self.min_room_id, id__lte=last_room_id))
-        room_list = [model_to_dict(room) for room in room_list]
-        return room_list
+        # Everything but visited comes from the cached topology, so only the
+        # ids of visited rooms are read from the database
+        from .maze_cache import get_topology
+        topology = get_topology(self.id)
+        if topology is None:
+            return []
+        return topology.rooms(set(self.visited_room_ids()))
+
+    def visited_room_ids(self):
+        return list(Room.objects.filter(game_id=self.id, visited=True).values_list('id', flat=True))
 
     def num_rooms(self):
         return self.map_columns * self.map_columns
@@ -130,15 +198,26 @@ class Game(models.Model):
         return Player.objects.filter(game_id=self.id).count()
 
     def get_games_UUIDs(self, player_uuid):
-        players_list = list(Player.objects.filter(game_id=self.id))
-        for i in range(len(players_list)):
-            players_list[i] = model_to_dict(players_list[i])['uuid']
-        return list(filter(lambda p_uuid: p_uuid !=
-                           player_uuid, players_list))
+        return list(Player.objects.filter(game_id=self.id).exclude(
+            uuid=player_uuid).values_list('uuid', flat=True))
 
     def reset_players(self):
         Player.objects.filter(game_id=self.id).update(current_room=-1,game_id=-1)
 
+    def finish(self, started=True):
+        # Ends the game and moves its players out. Only the request whose
+        # conditional UPDATE marks it finished wins, so the game is ended
+        # exactly once even when several players reach the end together.
+        # started=False also ends a game that is still in the lobby
+        games = Game.objects.filter(id=self.id, finished=False)
+        if started:
+            games = games.filter(in_progress=True)
+        with transaction.atomic():
+            if not games.update(in_progress=False, finished=True):
+                return False
+            self.reset_players()
+        return True
+
     @staticmethod
     def generate_title():
         adjectives = [
@@ -240,6 +319,7 @@ class Game(models.Model):
 
 
 class Room(models.Model):
+    game = models.ForeignKey(Game, on_delete=models.CASCADE, null=True, related_name='rooms')
     title = models.CharField(max_length=50, default="DEFAULT TITLE")
     description = models.CharField(
         max_length=500, default="DEFAULT DESCRIPTION")
@@ -249,6 +329,8 @@ class Room(models.Model):
     s = models.IntegerField(default=-1)
     e = models.IntegerField(default=-1)
     w = models.IntegerField(default=-1)
+    # Moves to the end of the maze, -1 when unknown (boards from stream_world)
+    distance = models.IntegerField(default=-1)
 
     def __str__(self):
         return f'Title: {self.title}, Description: {self.description} \n N: {self.n} S: {self.s} W: {self.w} E: {self.e}'
@@ -277,11 +359,14 @@ class Room(models.Model):
     #     except Room.DoesNotExist:
     #         return None
 
+    def occupants(self, currentPlayerID):
+        return room_occupants(self.id, currentPlayerID)
+
     def player_usernames(self, currentPlayerID):
-        return [p.user.username for p in Player.objects.filter(current_room=self.id) if p.user.id != int(currentPlayerID)]
+        return self.occupants(currentPlayerID)[0]
 
     def player_UUIDs(self, currentPlayerID):
-        return [p.uuid for p in Player.objects.filter(current_room=self.id) if p.user.id != int(currentPlayerID)]
+        return self.occupants(currentPlayerID)[1]
 
 
 class Player(models.Model):
@@ -291,12 +376,54 @@ class Player(models.Model):
     uuid = models.UUIDField(default=uuid.uuid4, unique=True)
     game_id = models.IntegerField(default=-1)
     moves = models.IntegerField(default=0)
+    # Joins on game_id and current_room without adding database constraints,
+    # so a request can select_related the player's game and room (see
+    # adventure/context.py). Both are None when the player is not in a game
+    current_game = models.ForeignObject(
+        Game, on_delete=models.DO_NOTHING, from_fields=('game_id',), to_fields=('id',),
+        null=True, related_name='+')
+    location = models.ForeignObject(
+        Room, on_delete=models.DO_NOTHING, from_fields=('current_room',), to_fields=('id',),
+        null=True, related_name='+')
+
+    class Meta:
+        indexes = [
+            # move/say/shout look players up by room, num_players and
+            # reset_players by game
+            models.Index(fields=['game_id', 'current_room']),
+            models.Index(fields=['current_room']),
+        ]
 
     def initialize(self, game_id, min_room_id):
         self.current_room = min_room_id
         self.game_id = game_id
         self.moves = 0
 
+    def join_game(self, game):
+        # A player's game_id is their game membership. The conditional UPDATE
+        # only reports a change the first time, so duplicate join requests
+        # do not announce the player again
+        joined = Player.objects.filter(pk=self.pk).exclude(game_id=game.id).update(
+            game_id=game.id, current_room=game.min_room_id, moves=0)
+        self.initialize(game.id, game.min_room_id)
+        return bool(joined)
+
+    def step(self, from_room, to_room, rooms=None):
+        # Moves the player only if they are still in from_room, counting the
+        # move in the database with F() so concurrent requests cannot lose
+        # moves or walk through two doors from the same room. rooms lists
+        # every room entered on the way when several steps are taken at once
+        rooms = rooms or [to_room]
+        with transaction.atomic():
+            moved = Player.objects.filter(pk=self.pk, game_id=self.game_id, current_room=from_room).update(
+                current_room=to_room, moves=F('moves') + len(rooms))
+            if moved:
+                Room.objects.filter(id__in=rooms, visited=False).update(visited=True)
+        # Read back without refresh_from_db, which would also drop the cached user
+        self.game_id, self.current_room, self.moves = Player.objects.values_list(
+            'game_id', 'current_room', 'moves').get(pk=self.pk)
+        return bool(moved)
+
     def room(self):
         try:
             # print(f"searching for room: {self.current_room}")
@@ -311,6 +438,22 @@ class Player(models.Model):
         except Game.DoesNotExist:
             return None
 
+def room_occupants(room_id, currentPlayerID):
+    # Usernames and UUIDs of everyone else in the room, in a single query
+    return rooms_occupants([room_id], currentPlayerID)[room_id]
+
+def rooms_occupants(room_ids, currentPlayerID):
+    # (usernames, uuids) of everyone else in each of the rooms, in a single
+    # query. Room -1 is where players outside a game are, not a room
+    occupants = {room_id: ([], []) for room_id in room_ids}
+    rows = Player.objects.filter(current_room__in=[room_id for room_id in room_ids if room_id != -1]).exclude(
+        user_id=currentPlayerID).values_list('current_room', 'user__username', 'uuid')
+    for room_id, username, p_uuid in rows:
+        occupants[room_id][0].append(username)
+        occupants[room_id][1].append(p_uuid)
+    return occupants
+
+
 # These callbacks run after a row in the User document is saved
 @receiver(post_save, sender=User)
 def create_user_player(sender, instance, created, **kwargs):
@@ -0,0 +1,166 @@
+import cProfile
+import gc
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.http import FileResponse, Http404, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from gevent import monkey
+from greenlet import greenlet
+from rest_framework import exceptions
+
+from .authentication import CachedTokenAuthentication
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+MAX_SECONDS = 120
+DEFAULT_INTERVAL = 0.01
+# Only files this module wrote can be downloaded
+FILE_NAME = re.compile(r'^adventure-[0-9]+-[0-9]+\.(folded|prof)$')
+
+# A real lock even under gevent, as the sampler's OS thread takes it too
+_lock = monkey.get_original('_thread', 'allocate_lock')()
+_sampler = None
+
+
+def profile_path(extension):
+    name = f'adventure-{os.getpid()}-{int(time.time() * 1000)}.{extension}'
+    return os.path.join(settings.PROFILE_DIR, name)
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+class Sampler:
+    # Statistical profiler for the whole process. Every interval it records
+    # the stack of every other thread; nothing runs inside the profiled
+    # code, so the cost is one stack walk per thread per sample. The result
+    # is written in the collapsed format flamegraph.pl and speedscope read.
+    # Under gevent's monkey patching threads are greenlets, so the sampler
+    # runs on a real OS thread with the real sleep, and also records the
+    # stack of every suspended greenlet (the running one is in the OS
+    # thread's frame)
+
+    def __init__(self, seconds, interval, path):
+        self.seconds = seconds
+        self.interval = interval
+        self.path = path
+        self.stacks = Counter()
+        self.greenlets = monkey.is_module_patched('threading')
+        self.ident = None
+
+    def start(self):
+        start_new_thread = monkey.get_original('_thread', 'start_new_thread')
+        start_new_thread(self.run, ())
+
+    def run(self):
+        global _sampler
+        self.ident = monkey.get_original('_thread', 'get_ident')()
+        sleep = monkey.get_original('time', 'sleep')
+        try:
+            deadline = time.monotonic() + self.seconds
+            while time.monotonic() < deadline:
+                self.sample()
+                sleep(self.interval)
+            with open(self.path, 'w') as output:
+                for stack, count in self.stacks.most_common():
+                    output.write(f'{stack} {count}\n')
+        finally:
+            with _lock:
+                _sampler = None
+
+    def frames(self):
+        frames = [frame for thread_id, frame in sys._current_frames().items() if thread_id != self.ident]
+        if self.greenlets:
+            frames.extend(obj.gr_frame for obj in gc.get_objects()
+                          if isinstance(obj, greenlet) and obj.gr_frame is not None)
+        return frames
+
+    def sample(self):
+        for frame in self.frames():
+            stack = []
+            while frame is not None:
+                stack.append(frame_name(frame))
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(stack))] += 1
+
+
+def start_sampling(seconds, interval=DEFAULT_INTERVAL):
+    # One sampler per process. Returns its output path, or None when one is
+    # already running
+    global _sampler
+    with _lock:
+        if _sampler is not None:
+            return None
+        _sampler = Sampler(min(seconds, MAX_SECONDS), interval, profile_path('folded'))
+        _sampler.start()
+        return _sampler.path
+
+
+@csrf_exempt
+@staff_member_required
+def profile_view(request):
+    # POST ?seconds=N starts sampling the worker that serves the request
+    # and returns at once, so a sync worker is sampled while it carries on
+    # serving traffic. GET lists finished profiles, GET ?file=<name>
+    # downloads one. Any worker on the host can serve the download. Like
+    # the API views it skips CSRF, so it can be driven with curl
+    if request.method == 'POST':
+        try:
+            seconds = float(request.GET.get('seconds', 10))
+            interval = float(request.GET.get('interval', DEFAULT_INTERVAL))
+        except ValueError:
+            return JsonResponse({'error': 'seconds and interval must be numbers'}, status=400)
+        if seconds <= 0 or interval <= 0:
+            return JsonResponse({'error': 'seconds and interval must be positive'}, status=400)
+        path = start_sampling(seconds, interval)
+        if path is None:
+            return JsonResponse({'error': 'This worker is already being profiled'}, status=409)
+        return JsonResponse({'pid': os.getpid(), 'seconds': min(seconds, MAX_SECONDS),
+                             'file': os.path.basename(path)}, status=202)
+
+    name = request.GET.get('file')
+    if name is None:
+        files = sorted(name for name in os.listdir(settings.PROFILE_DIR) if FILE_NAME.match(name))
+        return JsonResponse({'files': files})
+    path = os.path.join(settings.PROFILE_DIR, name)
+    if not FILE_NAME.match(name) or not os.path.exists(path):
+        raise Http404
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=name)
+
+
+def is_staff(request):
+    # API clients send a token; the admin pages use the session user set by
+    # AuthenticationMiddleware, which runs before ProfileMiddleware
+    try:
+        auth = CachedTokenAuthentication().authenticate(request)
+    except exceptions.AuthenticationFailed:
+        return False
+    user = auth[0] if auth is not None else getattr(request, 'user', None)
+    return user is not None and user.is_staff
+
+
+class ProfileMiddleware:
+    # A request sent with an X-Profile header by a staff user runs under
+    # cProfile, and the response names the stats file in X-Profile-File.
+    # The user is checked first, so nobody else can make a worker pay for
+    # profiling their requests
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if PROFILE_HEADER not in request.META or not is_staff(request):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        response = profiler.runcall(self.get_response, request)
+        path = profile_path('prof')
+        profiler.dump_stats(path)
+        response['X-Profile-File'] = os.path.basename(path)
+        return response
@@ -0,0 +1,95 @@
+import threading
+from datetime import timedelta
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .create_maze import DEFAULT_ALGORITHM
+from .lobby_pool import POOL_SIZES, pool_depth
+from .models import Game, Room
+
+# Rooms removed per DELETE statement, so no single statement holds locks
+# on a whole board
+CHUNK_SIZE = 2000
+# A claim older than this was left by a reaper that died, and is taken over
+CLAIM_SECONDS = 600
+
+_reap_lock = threading.Lock()
+_reaping = False
+
+
+def reap(chunk_size=CHUNK_SIZE, recycle=True):
+    # Clear out every finished game. Games the lobby pool is short of are
+    # recycled, everything else is deleted. Returns (recycled, deleted)
+    recycled = deleted = 0
+    for game in Game.objects.filter(finished=True).order_by('id'):
+        if not claim_for_reaping(game):
+            continue
+        if recycle and recycle_game(game):
+            recycled += 1
+        else:
+            delete_game(game, chunk_size)
+            deleted += 1
+    return recycled, deleted
+
+
+def claim_for_reaping(game):
+    # One conditional UPDATE decides which reaper handles a finished game;
+    # the others skip it. Both recycle_game and delete_game expect the
+    # game to be claimed
+    now = timezone.now()
+    unclaimed = Q(reaping_since__isnull=True) | Q(reaping_since__lt=now - timedelta(seconds=CLAIM_SECONDS))
+    return bool(Game.objects.filter(unclaimed, id=game.id, finished=True).update(reaping_since=now))
+
+
+def recycle_game(game):
+    # A finished maze is as good as a new one to the next players, so when
+    # the pool needs a game of this size it only has to be reset. Only whole
+    # boards are recycled, never one a dead reaper had started deleting
+    if (game.algorithm != DEFAULT_ALGORITHM or game.map_columns not in POOL_SIZES or
+            Game.objects.filter(pooled=True, map_columns=game.map_columns).count() >= pool_depth() or
+            Room.objects.filter(game_id=game.id).count() != game.num_rooms()):
+        return False
+    with transaction.atomic():
+        games = Game.objects.filter(id=game.id, finished=True)
+        if not games.update(finished=False, pooled=True, reaping_since=None):
+            return False
+        Room.objects.filter(game_id=game.id).exclude(id=game.min_room_id).update(visited=False)
+        Room.objects.filter(id=game.min_room_id).update(visited=True)
+    return True
+
+
+def delete_game(game, chunk_size=CHUNK_SIZE):
+    # A game's rooms have consecutive ids, so they are deleted in id ranges
+    # with plain DELETE statements. Nothing references a room by foreign
+    # key, so Django's cascade collector has nothing to do and is skipped
+    with connection.cursor() as cursor:
+        for low in range(game.min_room_id, game.min_room_id + game.num_rooms(), chunk_size):
+            cursor.execute(
+                f'DELETE FROM {Room._meta.db_table} WHERE game_id = %s AND id >= %s AND id < %s',
+                [game.id, low, low + chunk_size])
+        # Catches rooms outside the expected range, e.g. from older games
+        cursor.execute(f'DELETE FROM {Room._meta.db_table} WHERE game_id = %s', [game.id])
+    Game.objects.filter(id=game.id, finished=True).delete()
+
+
+def request_reap():
+    # Reap on a background thread. Only one runs per process; finishing
+    # games while it runs are picked up by its query or by the next one
+    global _reaping
+    with _reap_lock:
+        if _reaping:
+            return
+        _reaping = True
+
+    def run():
+        global _reaping
+        try:
+            reap()
+        finally:
+            with _reap_lock:
+                _reaping = False
+            connection.close()
+
+    threading.Thread(target=run, daemon=True).start()
@@ -1,3 +1,973 @@
-from django.test import TestCase
+import base64
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import textwrap
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection
+from django.db.models import Min
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+from pusher import Pusher
+from rest_framework.test import APIClient
+
+from . import api, engine, metrics, profiling
+from .broadcast import Broadcast
+from .context import PlayerContext
+from .create_maze import (ALGORITHMS, ALL_WALLS, DEFAULT_ALGORITHM, EAST, NORTH, OPPOSITE, SOUTH, WEST, Maze,
+                          eller_rows)
+from .dispatch import Dispatcher, get_dispatcher
+from .maze_cache import get_topology, invalidate
+from .models import Game, Player, Room, rooms_occupants
+from .reaper import CLAIM_SECONDS, claim_for_reaping, reap
+from .transport import LocalTransport
+
+
+class MazeTests(TestCase):
+
+    def assertPerfect(self, maze):
+        # Every cell is reachable and there are no loops: a spanning tree
+        # of the grid has exactly cells - 1 doors. Doors must also match on
+        # both sides, and the border must be closed
+        columns = maze.columns
+        doors = 0
+        for index, walls in enumerate(maze.walls):
+            for direction in (NORTH, EAST, SOUTH, WEST):
+                neighbor = maze.neighbor(index, direction)
+                if neighbor is None:
+                    self.assertTrue(walls & direction)
+                elif not walls & direction:
+                    self.assertFalse(maze.walls[neighbor] & OPPOSITE[direction])
+                    doors += direction in (EAST, SOUTH)
+        self.assertEqual(doors, columns * columns - 1)
+        self.assertNotIn(-1, maze.distances_from(0))
+
+    def test_same_seed_same_maze(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                self.assertEqual(Maze(20, 7, algorithm).walls, Maze(20, 7, algorithm).walls)
+                self.assertNotEqual(Maze(20, 7, algorithm).walls, Maze(20, 8, algorithm).walls)
+
+    def test_perfect_maze(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                for seed in range(5):
+                    self.assertPerfect(Maze(12, seed, algorithm))
+
+    def test_smallest_boards(self):
+        for algorithm in ALGORITHMS:
+            with self.subTest(algorithm=algorithm):
+                self.assertEqual(Maze(1, 1, algorithm).walls, bytearray([ALL_WALLS]))
+                for seed in range(5):
+                    self.assertPerfect(Maze(2, seed, algorithm))
+
+    def test_unknown_algorithm(self):
+        with self.assertRaises(ValueError):
+            Maze(4, algorithm='nope')
+
+    @override_settings(LOBBY_POOL_DEPTH=0)
+    def test_join_with_an_algorithm(self):
+        with mock.patch.object(api, 'transport', mock.Mock()):
+            # An unknown name is no preference, so it builds a default game
+            for columns, name, algorithm in ((3, 'kruskal', 'kruskal'), (4, 'nope', DEFAULT_ALGORITHM)):
+                client = APIClient()
+                client.force_authenticate(User.objects.create_user(f'maze-{name}'))
+                data = client.get(f'/api/adv/join/?columns={columns}&algorithm={name}').json()
+                game = Game.objects.get(id=data['game']['id'])
+                self.assertEqual(game.algorithm, algorithm)
+                self.assertEqual(Room.objects.filter(game_id=game.id).count(), columns * columns)
+
+
+class PusherStub(BaseHTTPRequestHandler):
+    # Stands in for the Pusher HTTP API and records every call it receives
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.calls.append((self.path.split('?')[0].rsplit('/', 1)[-1], body))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(b'{}')
+
+    def log_message(self, *args):
+        pass
+
+
+class PusherStubTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), PusherStub)
+        cls.server.calls = []
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.pusher = Pusher(app_id='1', key='key', secret='secret', ssl=False,
+                            host='127.0.0.1', port=cls.server.server_port)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.calls.clear()
+
+    def calls(self, endpoint=None):
+        return [body for name, body in self.server.calls if endpoint in (None, name)]
+
+
+class BroadcastTests(PusherStubTestCase):
+
+    def test_identical_events_share_one_trigger(self):
+        events = Broadcast(self.pusher)
+        uuids = [uuid.uuid4() for _ in range(20)]
+        events.send(uuids, {'message': 'hello'})
+        events.flush()
+        calls = self.calls()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0]['channels']), 20)
+        self.assertEqual(json.loads(calls[0]['data']), {'message': 'hello'})
+
+    def test_channels_are_split_into_groups_of_100(self):
+        events = Broadcast(self.pusher)
+        events.send([uuid.uuid4() for _ in range(150)], {'message': 'hello'})
+        events.flush()
+        self.assertEqual([len(c['channels']) for c in self.calls('events')], [100, 50])
+
+    def test_single_channel_events_are_batched(self):
+        events = Broadcast(self.pusher)
+        for i in range(12):
+            events.send([uuid.uuid4()], {'message': f'hello {i}'})
+        events.flush()
+        self.assertEqual([len(c['batch']) for c in self.calls('batch_events')], [10, 2])
+        self.assertEqual(self.calls('events'), [])
+
+    def test_nothing_is_sent_without_recipients(self):
+        events = Broadcast(self.pusher)
+        events.send([], {'message': 'hello'})
+        events.flush()
+        self.assertEqual(self.calls(), [])
+
+
+@override_settings(LOBBY_POOL_DEPTH=0)
+class ViewBroadcastTests(PusherStubTestCase):
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.object(api, 'transport', self.pusher)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def join(self, players):
+        clients = []
+        for i in range(players):
+            client = APIClient()
+            client.force_authenticate(User.objects.create_user(f'player{i}'))
+            client.get('/api/adv/join/?columns=2')
+            clients.append(client)
+        get_dispatcher().wait_idle(timeout=5)
+        return clients
+
+    def test_shout_reaches_every_player_in_one_call(self):
+        clients = self.join(5)
+        self.server.calls.clear()
+
+        clients[0].post('/api/adv/shout/', json.dumps({'message': 'hi'}),
+                        content_type='application/json')
+        get_dispatcher().wait_idle(timeout=5)
+
+        calls = self.calls()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(len(calls[0]['channels']), 4)
+
+    def test_say_outside_a_game_reaches_nobody(self):
+        clients = []
+        for i in range(3):
+            client = APIClient()
+            client.force_authenticate(User.objects.create_user(f'idle{i}'))
+            clients.append(client)
+        response = clients[0].post('/api/adv/say/', json.dumps({'message': 'spam'}),
+                                   content_type='application/json')
+        self.assertEqual(response.json()['message'], 'You are not in a game')
+        self.assertEqual(rooms_occupants([-1], None), {-1: ([], [])})
+        get_dispatcher().wait_idle(timeout=5)
+        self.assertEqual(self.calls(), [])
+
+    def test_joining_is_announced_once(self):
+        clients = self.join(3)
+        # Only the second and third players had someone to announce themselves to
+        self.assertEqual(len(self.calls()), 2)
+        self.server.calls.clear()
+
+        clients[2].get('/api/adv/join/?columns=2')
+        for client in clients:
+            client.get('/api/adv/get_game/')
+        get_dispatcher().wait_idle(timeout=5)
+        self.assertEqual(self.calls(), [])
+
+
+class DispatcherTests(TestCase):
+
+    def test_failed_sends_are_retried(self):
+        attempts = []
+
+        def flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise ConnectionError
+
+        dispatcher = Dispatcher(retries=3, backoff=0.001)
+        dispatcher.submit(flaky)
+        self.assertTrue(dispatcher.wait_idle(timeout=5))
+        stats = dispatcher.stats()
+        self.assertEqual((stats['sent'], stats['retried'], stats['failed']), (1, 2, 0))
+
+    def test_jobs_are_sent_in_order(self):
+        sent = []
+
+        def send(i):
+            # Early jobs are the slowest, so a second worker would overtake them
+            time.sleep(0.001 * (50 - i) / 50)
+            sent.append(i)
+
+        dispatcher = Dispatcher(workers=settings.BROADCAST_WORKERS)
+        for i in range(50):
+            dispatcher.submit(send, i)
+        self.assertTrue(dispatcher.wait_idle(timeout=5))
+        self.assertEqual(sent, list(range(50)))
+
+    def test_oldest_job_is_dropped_when_full(self):
+        release = threading.Event()
+        sent = []
+        dispatcher = Dispatcher(max_size=2, workers=1, block=0)
+        dispatcher.submit(release.wait)
+        # Wait for the worker to pick up the blocking job
+        while dispatcher.stats()['in_flight'] == 0:
+            pass
+        for i in range(4):
+            dispatcher.submit(sent.append, i)
+        self.assertEqual(dispatcher.stats()['dropped'], 2)
+        release.set()
+        self.assertTrue(dispatcher.wait_idle(timeout=5))
+        self.assertEqual(sent, [2, 3])
+
+
+class LocalTransportTests(TestCase):
+
+    def test_events_reach_only_subscribed_channels(self):
+        transport = LocalTransport()
+        alice = transport.subscribe('p-channel-alice')
+        bob = transport.subscribe('p-channel-bob')
+        transport.trigger(['p-channel-alice'], 'broadcast', {'message': 'hi'})
+        transport.trigger_batch([{'channel': 'p-channel-bob', 'name': 'broadcast', 'data': {'message': 'yo'}}])
+        self.assertEqual(alice.get(timeout=1), ('broadcast', {'message': 'hi'}))
+        self.assertEqual(bob.get(timeout=1), ('broadcast', {'message': 'yo'}))
+        self.assertIsNone(alice.get(timeout=0))
+
+    def test_slow_subscribers_lose_the_oldest_events(self):
+        transport = LocalTransport(max_queued=2)
+        subscription = transport.subscribe('p-channel-alice')
+        for i in range(3):
+            transport.trigger('p-channel-alice', 'broadcast', {'n': i})
+        self.assertEqual([subscription.get(timeout=0)[1]['n'] for _ in range(2)], [1, 2])
+
+    @override_settings(BROADCAST_ASYNC=False)
+    def test_events_endpoint_streams_player_channel(self):
+        transport = LocalTransport()
+        user = User.objects.create_user('listener')
+        with mock.patch.object(api, 'transport', transport):
+            response = self.client.get(f'/api/adv/events/?token={user.auth_token.key}')
+            stream = iter(response.streaming_content)
+            self.assertEqual(next(stream), b'retry: 3000\n\n')
+            transport.trigger(f'p-channel-{user.player.uuid}', 'broadcast', {'message': 'hi'})
+            self.assertEqual(next(stream), b'event: broadcast\ndata: {"message": "hi"}\n\n')
+            response.close()
+        self.assertEqual(transport.subscriptions, {})
+
+
+@override_settings(LOBBY_POOL_DEPTH=0)
+class AuthenticationTests(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user('auth', password='secret')
+        self.client = APIClient()
+
+    def test_basic_auth_is_refused(self):
+        credentials = base64.b64encode(b'auth:secret').decode()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Basic {credentials}')
+        self.assertEqual(self.client.get('/api/adv/get_game/').status_code, 401)
+
+    def test_token_is_required(self):
+        self.assertEqual(self.client.get('/api/adv/get_game/').status_code, 401)
+        self.client.credentials(HTTP_AUTHORIZATION='Token nope')
+        self.assertEqual(self.client.get('/api/adv/get_game/').status_code, 401)
+
+    def test_token_stops_working_after_logout(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.user.auth_token.key}')
+        # The first request caches the token
+        self.assertEqual(self.client.get('/api/adv/get_game/').status_code, 200)
+        self.assertEqual(self.client.post('/api/logout/').status_code, 200)
+        self.assertEqual(self.client.get('/api/adv/get_game/').status_code, 401)
+
+
+@override_settings(BROADCAST_ASYNC=False)
+class ConcurrentMoveTests(TransactionTestCase):
+    # Real transactions, so the moves race on separate connections
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            # Shared-cache in-memory sqlite fails concurrent writers at once
+            # instead of waiting for the lock
+            self.skipTest('needs a database that queues concurrent writes')
+        for name in ('transport', 'request_reap'):
+            patcher = mock.patch.object(api, name, mock.Mock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.game = Game.objects.create(map_columns=3, in_progress=True)
+        self.game.create_world()
+        # Flushing the database lets sqlite hand out the same game id again
+        invalidate(self.game.id)
+        self.rooms = {room.id: room for room in Room.objects.filter(game_id=self.game.id)}
+
+    def place(self, players, room_id):
+        clients = []
+        for i in range(players):
+            user = User.objects.create_user(f'racer{i}')
+            Player.objects.filter(user=user).update(game_id=self.game.id, current_room=room_id)
+            client = APIClient()
+            # Fresh user, so request.user.player is not the cached pre-update row
+            client.force_authenticate(User.objects.get(pk=user.pk))
+            clients.append(client)
+        return clients
+
+    def move_all(self, moves):
+        def post(move):
+            client, direction = move
+            try:
+                return client.post('/api/adv/move/', json.dumps({'direction': direction}),
+                                   content_type='application/json').json()
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=len(moves)) as pool:
+            return list(pool.map(post, moves))
+
+    def test_parallel_moves_are_all_counted(self):
+        room = next(r for r in self.rooms.values()
+                    if r.e != -1 and not self.rooms[r.e].end)
+        client = self.place(1, room.id)[0]
+        results = self.move_all([(client, 'e')] * 8)
+        succeeded = [r for r in results if not r['error']]
+        self.assertGreaterEqual(len(succeeded), 1)
+        self.assertEqual(Player.objects.get(user__username='racer0').moves, len(succeeded))
+        self.assertTrue(Room.objects.get(id=room.e).visited)
+
+    def test_end_of_game_is_claimed_once(self):
+        end = next(r for r in self.rooms.values() if r.end)
+        direction, room_id = next((d, getattr(end, d)) for d in 'nsew' if getattr(end, d) != -1)
+        towards_end = {'n': 's', 's': 'n', 'e': 'w', 'w': 'e'}[direction]
+        clients = self.place(6, room_id)
+        results = self.move_all([(client, towards_end) for client in clients])
+        winners = [r for r in results if not r['error']]
+        self.assertEqual(len(winners), 1)
+        self.assertEqual(winners[0]['message'], 'Congratulations! You found the end of the maze!!')
+        self.assertTrue(Game.objects.get(id=self.game.id).finished)
+        self.assertFalse(Player.objects.filter(game_id=self.game.id).exists())
+        api.request_reap.assert_called_once_with()
+
+
+class ConcurrentBuildTests(TransactionTestCase):
+    # Refill threads, the pool worker and joinlobby can all build at once
+
+    def setUp(self):
+        if connection.vendor == 'sqlite' and connection.is_in_memory_db():
+            self.skipTest('needs a database that queues concurrent writes')
+
+    def test_builders_reserve_separate_rooms(self):
+        def build(columns):
+            try:
+                Game(map_columns=columns).create_world()
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            list(executor.map(build, [3, 4, 5, 6] * 2))
+        for game in Game.objects.all():
+            rooms = Room.objects.filter(game_id=game.id)
+            self.assertEqual(rooms.count(), game.num_rooms())
+            self.assertEqual(rooms.aggregate(Min('id'))['id__min'], game.min_room_id)
+
+
+class StreamWorldTests(TestCase):
+
+    def test_mega_mazes_are_joined_by_exact_size(self):
+        mega = Game.objects.create(map_columns=12, in_progress=False)
+        mega.stream_world()
+        with mock.patch.object(api, 'transport', mock.Mock()), \
+                mock.patch.object(api, 'MAX_MAZE_PAYLOAD_ROOMS', 100):
+            client = APIClient()
+            client.force_authenticate(User.objects.create_user('casual'))
+            data = client.get('/api/adv/join/').json()
+            self.assertNotEqual(data['game']['id'], mega.id)
+            self.assertTrue(data['maze'])
+
+            client = APIClient()
+            client.force_authenticate(User.objects.create_user('explorer'))
+            data = client.get('/api/adv/join/?columns=12').json()
+            self.assertEqual(data['game']['id'], mega.id)
+            self.assertEqual(data['maze'], [])
+
+    def test_only_the_start_room_is_visited(self):
+        # The same rule recycling uses, on every board and not just room 0's
+        for build in (Game.create_world, Game.stream_world) * 2:
+            game = Game.objects.create(map_columns=3)
+            build(game)
+            visited = Room.objects.filter(game_id=game.id, visited=True).values_list('id', flat=True)
+            self.assertEqual(list(visited), [game.min_room_id])
+
+    def test_builds_skip_a_range_still_being_written(self):
+        streaming = Game.objects.create(map_columns=4)
+        streaming.reserve_rooms()
+        game = Game(map_columns=2)
+        game.create_world()
+        self.assertEqual(game.min_room_id, streaming.min_room_id + 16)
+
+    def test_one_end_room_at_any_batch_size(self):
+        # 100 rooms: batches that divide it flush the last room in the loop
+        for batch_size in (7, 50, 100, 1000):
+            game = Game.objects.create(map_columns=10)
+            game.stream_world(batch_size=batch_size)
+            rooms = Room.objects.filter(game_id=game.id)
+            self.assertEqual(rooms.count(), 100)
+            self.assertEqual(list(rooms.filter(end=True).values_list('id', flat=True)), [game.min_room_id + 99])
+
+    def test_generation_stops_when_inserting_fails(self):
+        rows = []
+
+        def counted_rows(*args):
+            for row in eller_rows(*args):
+                rows.append(row)
+                yield row
+
+        game = Game.objects.create(map_columns=200)
+        with mock.patch('adventure.models.eller_rows', counted_rows), \
+                mock.patch.object(Room.objects, 'bulk_create', side_effect=ValueError):
+            with self.assertRaises(ValueError):
+                game.stream_world(batch_size=200)
+        # The first batch failed; the producer only got a few rows ahead
+        self.assertLess(len(rows), 20)
+
+
+class ReaperTests(TestCase):
+
+    def setUp(self):
+        self.game = Game.objects.create(map_columns=3, in_progress=True)
+        self.game.create_world()
+        Room.objects.filter(game_id=self.game.id).update(visited=True)
+        self.game.finish()
+
+    @override_settings(LOBBY_POOL_DEPTH=0)
+    def test_finished_games_are_deleted_in_chunks(self):
+        self.assertEqual(reap(chunk_size=2), (0, 1))
+        self.assertFalse(Game.objects.filter(id=self.game.id).exists())
+        self.assertFalse(Room.objects.filter(game_id=self.game.id).exists())
+
+    @override_settings(LOBBY_POOL_DEPTH=1)
+    def test_finished_games_refill_the_pool(self):
+        self.assertEqual(reap(), (1, 0))
+        game = Game.objects.get(id=self.game.id)
+        self.assertEqual((game.pooled, game.finished, game.in_progress), (True, False, False))
+        visited = Room.objects.filter(game_id=game.id, visited=True).values_list('id', flat=True)
+        self.assertEqual(list(visited), [game.min_room_id])
+
+    @override_settings(LOBBY_POOL_DEPTH=1)
+    def test_games_claimed_by_another_reaper_are_left_alone(self):
+        self.assertTrue(claim_for_reaping(self.game))
+        self.assertEqual(reap(), (0, 0))
+        self.assertEqual(Room.objects.filter(game_id=self.game.id).count(), self.game.num_rooms())
+        # Until the claim is old enough to be from a reaper that died
+        stale = timezone.now() - timedelta(seconds=CLAIM_SECONDS + 1)
+        Game.objects.filter(id=self.game.id).update(reaping_since=stale)
+        self.assertEqual(reap(), (1, 0))
+        self.assertIsNone(Game.objects.get(id=self.game.id).reaping_since)
+
+
+@override_settings(LOBBY_POOL_DEPTH=0, BROADCAST_ASYNC=False)
+class QueryBudgetTests(TestCase):
+    # Every endpoint has a fixed number of queries, however big the game is.
+    # Authentication, the player, their game and their room are one query;
+    # move and walk add a savepoint pair here for their transaction
+
+    def setUp(self):
+        for name in ('transport', 'request_reap'):
+            patcher = mock.patch.object(api, name, mock.Mock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.game = Game.objects.create(map_columns=4, in_progress=True)
+        self.game.create_world()
+        invalidate(self.game.id)
+        self.start = Room.objects.get(id=self.game.min_room_id)
+        self.clients = []
+        for i in range(3):
+            user = User.objects.create_user(f'budget{i}')
+            Player.objects.filter(user=user).update(game_id=self.game.id, current_room=self.start.id)
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+            self.clients.append(client)
+        # Caches the token and the maze topology, as for any player mid-game
+        self.clients[0].get('/api/adv/get_maze/?compact=1')
+
+    def assertBudget(self, budget, method, url, body=None):
+        client = self.clients[0]
+        with self.assertNumQueries(budget):
+            if method == 'get':
+                response = client.get(url)
+            else:
+                response = client.post(url, json.dumps(body), content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return response.json() if response['Content-Type'] == 'application/json' else None
+
+    def test_reads(self):
+        self.assertBudget(3, 'get', '/api/adv/get_game/')
+        # Counts every player in the game, not just those in the room
+        Player.objects.filter(user__username='budget2').update(current_room=self.start.id + 1)
+        data = self.assertBudget(4, 'get', '/api/adv/join/')
+        self.assertEqual(data['game']['num_players'], 3)
+        self.assertBudget(2, 'get', '/api/adv/get_maze/')
+        self.assertBudget(1, 'get', '/api/adv/get_maze/?compact=1')
+        self.assertBudget(2, 'get', '/api/adv/get_visited/')
+        self.assertBudget(1, 'get', '/api/adv/hint/')
+
+    def test_actions(self):
+        self.assertBudget(2, 'post', '/api/adv/say/', {'message': 'hi'})
+        self.assertBudget(2, 'post', '/api/adv/shout/', {'message': 'hi'})
+        self.assertBudget(4, 'get', '/api/adv/init/')
+        # Other players are still in the game, so end only counts them
+        self.assertBudget(2, 'get', '/api/adv/end/')
+
+    def test_moves(self):
+        wall = next(d for d in 'nsew' if getattr(self.start, d) == -1)
+        door = next(d for d in 'nsew' if getattr(self.start, d) != -1)
+        back = {'n': 's', 's': 'n', 'e': 'w', 'w': 'e'}[door]
+        self.assertBudget(3, 'post', '/api/adv/move/', {'direction': wall})
+        moved = self.assertBudget(8, 'post', '/api/adv/move/', {'direction': door})
+        self.assertEqual((moved['loc'], moved['moves']), (getattr(self.start, door), 1))
+        walked = self.assertBudget(8, 'post', '/api/adv/walk/', {'directions': [back]})
+        self.assertEqual((walked['loc'], walked['moves']), (self.start.id, 2))
+
+
+@override_settings(BROADCAST_ASYNC=False)
+class WalkTests(TestCase):
+
+    def setUp(self):
+        self.transport = LocalTransport()
+        for name, value in (('transport', self.transport), ('request_reap', mock.Mock())):
+            patcher = mock.patch.object(api, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.game = Game.objects.create(map_columns=4, in_progress=True)
+        self.game.create_world()
+        invalidate(self.game.id)
+        self.topology = get_topology(self.game.id)
+        user = User.objects.create_user('walker')
+        self.player = user.player
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+        # Three rooms in a row, none of them the end, and a wall in the last
+        self.rooms, self.directions, self.wall = next(self.corridors())
+        self.place(self.player, self.rooms[0])
+
+    def corridors(self):
+        topology = self.topology
+        for first in range(topology.min_room_id, topology.min_room_id + len(topology)):
+            for d1 in 'nsew':
+                second = topology.exit(first, d1)
+                for d2 in 'nsew':
+                    third = topology.exit(second, d2) if second != -1 else -1
+                    rooms = (first, second, third)
+                    if -1 in rooms or third == first or topology.end_id in rooms:
+                        continue
+                    for wall in 'nsew':
+                        if topology.exit(third, wall) == -1:
+                            yield list(rooms), [d1, d2], wall
+
+    def place(self, player, room_id):
+        Player.objects.filter(pk=player.pk).update(game_id=self.game.id, current_room=room_id)
+
+    def walk(self, body):
+        return self.client.post('/api/adv/walk/', json.dumps(body), content_type='application/json').json()
+
+    def test_path_lists_every_room_entered(self):
+        data = self.walk({'directions': self.directions})
+        self.assertEqual(data['path'], self.rooms[1:])
+        self.assertEqual((data['loc'], data['moves'], data['error']), (self.rooms[2], 2, False))
+        self.place(self.player, self.rooms[0])
+        data = self.walk({'target': self.rooms[2]})
+        self.assertEqual(data['path'], self.rooms[1:])
+
+    def test_stops_at_a_wall(self):
+        data = self.walk({'directions': self.directions + [self.wall, self.wall]})
+        self.assertEqual(data['path'], self.rooms[1:])
+        self.assertEqual((data['loc'], data['moves']), (self.rooms[2], 2))
+        self.assertEqual(data['message'], 'You cannot move that way.')
+
+    def test_stops_at_the_end(self):
+        end = self.topology.end_id
+        first = self.topology.min_room_id
+        room, direction = next((room, d) for room in range(first, first + len(self.topology))
+                               for d in 'nsew' if self.topology.exit(room, d) == end)
+        self.place(self.player, room)
+        data = self.walk({'directions': [direction] + ['n', 's'] * 3})
+        self.assertEqual(data['message'], 'Congratulations! You found the end of the maze!!')
+        self.assertTrue(Game.objects.get(id=self.game.id).finished)
+
+    def test_one_message_per_room(self):
+        subscriptions = []
+        for i, room_id in enumerate(self.rooms):
+            watcher = User.objects.create_user(f'watcher{i}').player
+            self.place(watcher, room_id)
+            subscriptions.append(self.transport.subscribe(f'p-channel-{watcher.uuid}'))
+        self.walk({'directions': self.directions})
+        events = [[subscription.get(timeout=0) for _ in range(2)] for subscription in subscriptions]
+        self.assertEqual([received[1] for received in events], [None] * 3)
+        self.assertIn('has walked', events[0][0][1]['message'])
+        self.assertEqual(events[1][0][1]['message'], 'walker passed through.')
+        self.assertIn('has entered from the', events[2][0][1]['message'])
+
+    def test_invalid_input(self):
+        for body, message in (({'target': 'end'}, 'Invalid Target'), ({'target': None}, 'Invalid Target'),
+                              ({'directions': 'n'}, 'Invalid Direction'), ({'directions': [1]}, 'Invalid Direction'),
+                              ({'directions': ['up']}, 'Invalid Direction')):
+            data = self.walk(body)
+            self.assertEqual((data['error'], data['message']), (True, message))
+        self.player.refresh_from_db()
+        self.assertEqual((self.player.current_room, self.player.moves), (self.rooms[0], 0))
+
+
+class CompactMazeTests(TestCase):
+
+    def setUp(self):
+        self.game = Game.objects.create(map_columns=4, in_progress=True)
+        self.game.create_world()
+        invalidate(self.game.id)
+        user = User.objects.create_user('mapper')
+        Player.objects.filter(user=user).update(game_id=self.game.id, current_room=self.game.min_room_id)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+
+    def test_compact_format(self):
+        data = self.client.get('/api/adv/get_maze/?compact=1').json()
+        self.assertEqual((data['error'], data['game_id'], data['columns'], data['min_room_id']),
+                         (False, self.game.id, 4, self.game.min_room_id))
+        rooms = Room.objects.filter(game_id=self.game.id).order_by('id')
+        self.assertEqual(len(data['doors']), 16)
+        for i, room in enumerate(rooms):
+            doors = data['doors'][i]
+            self.assertEqual([bool(doors & bit) for bit in (NORTH, EAST, SOUTH, WEST)],
+                             [room.n != -1, room.e != -1, room.s != -1, room.w != -1])
+            self.assertEqual(data['strings'][data['titles'][i]], room.title)
+            self.assertEqual(data['strings'][data['descriptions'][i]], room.description)
+        self.assertEqual(data['end'], rooms.get(end=True).id)
+        # Repeated titles and descriptions are stored once
+        self.assertEqual(len(data['strings']), len(set(data['strings'])))
+
+    def test_revalidated_with_the_etag(self):
+        response = self.client.get('/api/adv/get_maze/?compact=1')
+        etag = response['ETag']
+        self.assertEqual(etag, f'"maze-{self.game.id}"')
+        response = self.client.get('/api/adv/get_maze/?compact=1', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual((response.status_code, response.content, response['ETag']), (304, b'', etag))
+        response = self.client.get('/api/adv/get_maze/?compact=1', HTTP_IF_NONE_MATCH='"maze-0"')
+        self.assertEqual(response.status_code, 200)
+
+    def test_game_without_rooms(self):
+        game = Game.objects.create(map_columns=4)
+        Player.objects.filter(user__username='mapper').update(game_id=game.id, current_room=0)
+        self.assertEqual(self.client.get('/api/adv/get_maze/').json(), {'error': False, 'maze': []})
+        self.assertEqual(self.client.get('/api/adv/get_maze/?compact=1').json(),
+                         {'error': True, 'message': 'This game has no maze yet'})
+
+
+class MazeCacheTests(TestCase):
+
+    def setUp(self):
+        self.games = []
+        for i in range(3):
+            game = Game.objects.create(map_columns=2, in_progress=True)
+            game.create_world()
+            invalidate(game.id)
+            self.addCleanup(invalidate, game.id)
+            self.games.append(game.id)
+
+    @override_settings(MAZE_CACHE_SIZE=1)
+    def test_least_recently_used_is_evicted(self):
+        a, b = self.games[:2]
+        topology = get_topology(a)
+        self.assertIs(get_topology(a), topology)
+        get_topology(b)
+        self.assertIsNot(get_topology(a), topology)
+
+    @override_settings(MAZE_CACHE_SIZE=2)
+    def test_reading_a_maze_keeps_it(self):
+        a, b, c = self.games
+        topologies = {game_id: get_topology(game_id) for game_id in (a, b)}
+        get_topology(a)
+        get_topology(c)
+        self.assertIs(get_topology(a), topologies[a])
+        self.assertIsNot(get_topology(b), topologies[b])
+
+    def test_ending_the_game_drops_its_maze(self):
+        user = User.objects.create_user('quitter')
+        Player.objects.filter(user=user).update(game_id=self.games[0], current_room=0)
+        topology = get_topology(self.games[0])
+        client = APIClient()
+        client.force_authenticate(user)
+        with mock.patch.object(api, 'request_reap', mock.Mock()):
+            self.assertEqual(client.get('/api/adv/end/').json()['message'], 'Game quit!')
+        self.assertIsNot(get_topology(self.games[0]), topology)
+
+
+class HintTests(TestCase):
+
+    def setUp(self):
+        for name in ('transport', 'request_reap'):
+            patcher = mock.patch.object(api, name, mock.Mock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.game = Game.objects.create(map_columns=6, in_progress=True)
+        self.game.create_world()
+        invalidate(self.game.id)
+        user = User.objects.create_user('follower')
+        Player.objects.filter(user=user).update(game_id=self.game.id, current_room=self.game.min_room_id)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+
+    def test_hints_lead_to_the_end_in_distance_moves(self):
+        hint = self.client.get('/api/adv/hint/').json()
+        self.assertEqual(hint['loc'], self.game.min_room_id)
+        distance = hint['distance']
+        self.assertGreater(distance, 0)
+        for moves in range(1, distance + 1):
+            data = self.client.post('/api/adv/move/', json.dumps({'direction': hint['direction'], 'distance': True}),
+                                    content_type='application/json').json()
+            if moves == distance:
+                break
+            self.assertEqual((data['moves'], data['distance']), (moves, distance - moves))
+            hint = self.client.get('/api/adv/hint/').json()
+            self.assertEqual((hint['loc'], hint['distance']), (data['loc'], data['distance']))
+        self.assertEqual(data['message'], 'Congratulations! You found the end of the maze!!')
+        self.assertTrue(Game.objects.get(id=self.game.id).finished)
+
+    def test_distance_is_only_sent_when_asked_for(self):
+        direction = self.client.get('/api/adv/hint/').json()['direction']
+        data = self.client.post('/api/adv/move/', json.dumps({'direction': direction}),
+                                content_type='application/json').json()
+        self.assertEqual(data['error'], False)
+        self.assertNotIn('distance', data)
+
+
+@override_settings(METRICS_ENABLED=True, LOBBY_POOL_DEPTH=0, BROADCAST_ASYNC=False)
+class MetricsTests(TestCase):
+
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        patcher = mock.patch.object(api, 'transport', mock.Mock())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.clients = []
+        for i in range(2):
+            user = User.objects.create_user(f'metrics{i}')
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+            self.clients.append(client)
+        self.client = self.clients[0]
+
+    def test_views_and_generation_are_measured(self):
+        for client in self.clients:
+            client.get('/api/adv/join/?columns=3')
+        self.client.post('/api/adv/say/', json.dumps({'message': 'hi'}), content_type='application/json')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('adventure_request_seconds_count{view="joinlobby"} 2', text)
+        self.assertIn('adventure_db_queries_sum{view="say"} 2', text)
+        self.assertIn('adventure_pusher_calls_sum{view="say"} 1', text)
+        self.assertIn('adventure_pusher_seconds_count{view="say"} 1', text)
+        self.assertIn('adventure_response_bytes_count{view="joinlobby"} 2', text)
+        for phase in ('generate_rooms', 'generate_maze', 'generate_end'):
+            self.assertIn(f'adventure_generation_seconds_count{{phase="{phase}"}} 1', text)
+
+    @override_settings(METRICS_ENABLED=False)
+    def test_disabled(self):
+        self.assertEqual(self.client.get('/metrics').status_code, 404)
+
+
+class ProfilingTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        patcher = override_settings(PROFILE_DIR=directory.name)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        self.staff = User.objects.create_user('staff', password='x', is_staff=True)
+
+    def test_sampling(self):
+        self.client.force_login(self.staff)
+        response = self.client.post('/admin/profile/?seconds=0.05&interval=0.005')
+        self.assertEqual(response.status_code, 202)
+        name = response.json()['file']
+        for _ in range(100):
+            if name in self.client.get('/admin/profile/').json()['files']:
+                break
+            time.sleep(0.01)
+        response = self.client.get(f'/admin/profile/?file={name}')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'test_sampling (tests.py:', b''.join(response.streaming_content))
+        self.assertEqual(self.client.get('/admin/profile/?file=../settings.py').status_code, 404)
+
+    def test_sampling_greenlets(self):
+        # gevent workers monkey patch the whole process, so this runs in a
+        # fresh one. The greenlet must show up, not just the sampler
+        script = textwrap.dedent("""
+            from gevent import monkey
+            monkey.patch_all()
+            import sys
+            import django
+            import gevent
+            django.setup()
+            from adventure.profiling import Sampler
+
+            def busy_greenlet():
+                while True:
+                    gevent.sleep(0.001)
+
+            gevent.spawn(busy_greenlet)
+            Sampler(0.2, 0.005, sys.argv[1]).start()
+            gevent.sleep(1)
+        """)
+        path = os.path.join(settings.PROFILE_DIR, 'greenlets.folded')
+        subprocess.run([sys.executable, '-c', script, path], check=True, timeout=30)
+        with open(path) as profile:
+            self.assertIn('busy_greenlet (<string>:', profile.read())
+
+    def test_staff_only(self):
+        self.client.force_login(User.objects.create_user('player'))
+        self.assertEqual(self.client.post('/admin/profile/?seconds=1').status_code, 302)
+
+    def test_profile_header(self):
+        player = User.objects.create_user('player')
+        for user, profiled in ((self.staff, True), (player, False)):
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+            with mock.patch.object(profiling.cProfile, 'Profile', wraps=profiling.cProfile.Profile) as profile:
+                response = client.get('/api/adv/get_game/', HTTP_X_PROFILE='1')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual('X-Profile-File' in response, profiled)
+            # Other users' requests are not even run under the profiler
+            self.assertEqual(profile.called, profiled)
+
+    def test_profile_header_from_the_admin(self):
+        self.client.force_login(self.staff)
+        self.assertIn('X-Profile-File', self.client.get('/admin/profile/', HTTP_X_PROFILE='1'))
+        bad_token = self.client.get('/admin/profile/', HTTP_X_PROFILE='1', HTTP_AUTHORIZATION='Token nope')
+        self.assertNotIn('X-Profile-File', bad_token)
+
+
+@override_settings(GAME_ENGINE='memory', LOBBY_POOL_DEPTH=0, BROADCAST_ASYNC=False)
+class EngineTests(TestCase):
+
+    def setUp(self):
+        for target, name in ((api, 'transport'), (api, 'request_reap'), (engine, 'start_flusher')):
+            patcher = mock.patch.object(target, name, mock.Mock())
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        engine._states.clear()
+        self.addCleanup(engine._states.clear)
+        self.game = Game.objects.create(map_columns=4, in_progress=True)
+        self.game.create_world()
+        invalidate(self.game.id)
+        self.start = self.game.min_room_id
+        self.clients = []
+        for i in range(2):
+            user = User.objects.create_user(f'engine{i}')
+            Player.objects.filter(user=user).update(game_id=self.game.id, current_room=self.start)
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {user.auth_token.key}')
+            self.clients.append(client)
+        self.player = Player.objects.get(user__username='engine0')
+        topology = get_topology(self.game.id)
+        self.direction = topology.hint(self.start)
+        self.next_room = topology.exit(self.start, self.direction)
+
+    def move(self, client, direction):
+        return client.post('/api/adv/move/', json.dumps({'direction': direction}),
+                           content_type='application/json').json()
+
+    def test_moves_are_written_behind(self):
+        self.move(self.clients[0], self.direction)
+        self.player.refresh_from_db()
+        self.assertEqual(self.player.current_room, self.start)
+        # Once the game is loaded a move only needs the authentication query
+        with self.assertNumQueries(1):
+            data = self.move(self.clients[0], 'nsew'['snwe'.index(self.direction)])
+        self.assertEqual((data['loc'], data['moves']), (self.start, 2))
+        data = self.move(self.clients[0], self.direction)
+        self.assertEqual(self.clients[1].get('/api/adv/get_game/').json()['game']['usernames'], [])
+
+        engine.flush_all()
+        self.player.refresh_from_db()
+        self.assertEqual((self.player.current_room, self.player.moves), (self.next_room, 3))
+        self.assertTrue(Room.objects.get(id=self.next_room).visited)
+
+    def test_rebuilt_from_database(self):
+        self.move(self.clients[0], self.direction)
+        engine.flush_all()
+        # As after a restart
+        engine._states.clear()
+        data = self.clients[0].get('/api/adv/get_game/').json()
+        self.assertEqual(data['current_room']['loc'], self.next_room)
+        self.assertTrue(data['current_room']['visited'])
+        self.assertIn(self.next_room, self.clients[0].get('/api/adv/get_visited/').json()['visited'])
+
+    def context(self):
+        context = PlayerContext(User.objects.get(username='engine0'))
+        self.assertIsNotNone(context.state)
+        return context
+
+    def test_moving_after_an_idle_close(self):
+        context = self.context()
+        engine.close(self.game.id)
+        self.assertTrue(context.step(self.start, self.next_room))
+        self.assertEqual(engine._states[self.game.id].players[self.player.pk].room, self.next_room)
+
+    def test_moving_after_the_game_ended(self):
+        context = self.context()
+        engine.close(self.game.id)
+        self.game.finish()
+        self.assertFalse(context.step(self.start, self.next_room))
+        self.assertEqual(context.player.current_room, -1)
+        data = self.move(self.clients[0], self.direction)
+        self.assertEqual(data['message'], 'The game has already ended! Someone found the end of the maze!!')
+
+    def test_finishing_writes_out_the_game(self):
+        self.move(self.clients[1], self.direction)
+        end = Room.objects.get(game_id=self.game.id, end=True).id
+        data = self.clients[0].post('/api/adv/walk/', json.dumps({'target': end}),
+                                    content_type='application/json').json()
+        self.assertEqual(data['message'], 'Congratulations! You found the end of the maze!!')
+        self.assertNotIn(self.game.id, engine._states)
+        self.assertTrue(Room.objects.get(id=self.next_room).visited)
+        self.assertTrue(Game.objects.get(id=self.game.id).finished)
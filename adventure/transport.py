@@ -0,0 +1,88 @@
+import threading
+from collections import deque
+
+from decouple import config
+from django.conf import settings
+
+# Every transport takes the same calls as the Pusher client:
+#   trigger(channels, event_name, data) and trigger_batch(batch)
+
+
+def pusher_transport():
+    from pusher import Pusher
+    return Pusher(
+        app_id=config('PUSHER_APP_ID'),
+        key=config('PUSHER_KEY'),
+        secret=config('PUSHER_SECRET'),
+        cluster=config('PUSHER_CLUSTER'),
+        ssl=True,
+    )
+
+
+class Subscription:
+    # One connected client's queue of pending events. It is bounded, and
+    # when a slow client falls behind the oldest events are dropped
+
+    def __init__(self, channel, max_queued):
+        self.channel = channel
+        self.events = deque(maxlen=max_queued)
+        self.ready = threading.Condition()
+
+    def put(self, event_name, data):
+        with self.ready:
+            self.events.append((event_name, data))
+            self.ready.notify()
+
+    def get(self, timeout=None):
+        # Next (event_name, data) pair, or None if nothing arrived in time
+        with self.ready:
+            if not self.ready.wait_for(lambda: self.events, timeout):
+                return None
+            return self.events.popleft()
+
+
+class LocalTransport:
+    # Self-hosted transport: events go straight into the queues of the
+    # clients subscribed in this process and are streamed out by the
+    # events endpoint. It only reaches clients connected to the same
+    # process, so it suits single-node deployments
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+        self.lock = threading.Lock()
+        self.subscriptions = {}
+
+    def subscribe(self, channel):
+        subscription = Subscription(channel, self.max_queued)
+        with self.lock:
+            self.subscriptions.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscriptions = self.subscriptions.get(subscription.channel, set())
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                self.subscriptions.pop(subscription.channel, None)
+
+    def trigger(self, channels, event_name, data):
+        if isinstance(channels, str):
+            channels = [channels]
+        with self.lock:
+            targets = [s for channel in channels for s in self.subscriptions.get(channel, ())]
+        for subscription in targets:
+            subscription.put(event_name, data)
+
+    def trigger_batch(self, batch):
+        for event in batch:
+            self.trigger(event['channel'], event['name'], event['data'])
+
+
+TRANSPORTS = {
+    'pusher': pusher_transport,
+    'local': LocalTransport,
+}
+
+
+def get_transport():
+    return TRANSPORTS[settings.EVENT_TRANSPORT]()
@@ -10,4 +10,8 @@ urlpatterns = [
     url('shout', api.shout),
     url('end', api.end),
     url('get_maze', api.get_maze),
+    url('get_visited', api.get_visited),
+    url('events', api.events),
+    url('walk', api.walk),
+    url('hint', api.hint),
 ]
\ No newline at end of file
@@ -0,0 +1,43 @@
+# Gunicorn settings for the web process (see "Deployment" in README.md)
+import os
+
+# Only gunicorn setting names may be bound at module level, and 'config'
+# is one of them, so decouple is used through its module
+import decouple
+
+# gevent workers run every request and event stream as a greenlet, so one
+# worker holds up to GUNICORN_CONNECTIONS of them at once and a request
+# waiting on Postgres or Pusher only pauses its own greenlet. Set
+# GUNICORN_WORKER_CLASS=sync for one request per worker process
+worker_class = decouple.config('GUNICORN_WORKER_CLASS', default='gevent')
+workers = decouple.config('WEB_CONCURRENCY', default=2, cast=int)
+worker_connections = decouple.config('GUNICORN_CONNECTIONS', default=1000, cast=int)
+keepalive = decouple.config('GUNICORN_KEEPALIVE', default=5, cast=int)
+
+if worker_class == 'gevent':
+    # Every greenlet gets its own database connection, so requests share a
+    # pool of them instead of opening one each. Read by settings.py
+    os.environ.setdefault('DB_GEVENT_POOL', 'True')
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 is a C extension that gevent cannot patch; this makes
+        # its queries yield to other greenlets while waiting on Postgres
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def on_starting(server):
+    # Modes whose state lives in one process must not be split across
+    # several workers; refuse to start rather than diverge silently
+    if server.cfg.workers == 1:
+        return
+    if decouple.config('GAME_ENGINE', default='database') == 'memory':
+        raise RuntimeError(
+            f'GAME_ENGINE=memory keeps each game in one process but {server.cfg.workers} workers '
+            f'are configured; set WEB_CONCURRENCY=1')
+    if decouple.config('EVENT_TRANSPORT', default='pusher') == 'local':
+        raise RuntimeError(
+            f'EVENT_TRANSPORT=local only reaches event streams held by the same process but '
+            f'{server.cfg.workers} workers are configured; set WEB_CONCURRENCY=1')